@@ -0,0 +1,77 @@
+"""
+Compares JSON decoding of large `get_messages` and `get_chats` pages.
+
+    $ PYTHONPATH=. python benchmarks/json_codec.py [--repeat N]
+
+`requests` is the old path (decode the body to text, then json.loads),
+every codec in util.JSON_CODECS parses the raw response bytes.
+"""
+import argparse
+import json
+import timeit
+
+from tambotapi import util
+
+
+def messages_page(count=100, text_size=2000):
+    return {
+        'messages': [{
+            'sender': {'user_id': 100000 + i, 'name': 'User {0}'.format(i), 'username': 'user{0}'.format(i)},
+            'recipient': {'chat_id': -1000 - i, 'chat_type': 'chat', 'user_id': None},
+            'timestamp': 1570000000000 + i,
+            'link': None,
+            'body': {
+                'mid': 'mid.{0:016x}'.format(i),
+                'seq': 102000000000 + i,
+                'text': u'Привет, world! ' * (text_size // 15),
+                'attachments': [{'type': 'image', 'payload': {'photo_id': i, 'token': 'x' * 64,
+                                                              'url': 'https://i.oneme.ru/i?r={0}'.format(i)}}],
+            },
+            'stat': {'views': i * 3},
+            'url': 'https://tt.me/chat/{0}'.format(i),
+        } for i in range(count)],
+    }
+
+
+def chats_page(count=100):
+    return {
+        'chats': [{
+            'chat_id': -1000 - i,
+            'type': 'chat',
+            'status': 'active',
+            'title': u'Чат номер {0}'.format(i),
+            'icon': {'url': 'https://i.oneme.ru/i?r={0}'.format(i)},
+            'last_event_time': 1570000000000 + i,
+            'participants_count': 500 + i,
+            'owner_id': 100000 + i,
+            'participants': {str(100000 + j): 1570000000000 + j for j in range(50)},
+            'is_public': False,
+            'link': None,
+            'description': u'Описание ' * 20,
+        } for i in range(count)],
+        'marker': 100,
+    }
+
+
+def bench(name, raw, repeat):
+    timings = {'requests': min(timeit.repeat(lambda: json.loads(raw.decode('utf-8')), number=repeat, repeat=3))}
+    for codec in util.JSON_CODECS.values():
+        timings[codec.name] = min(timeit.repeat(lambda: codec.loads(raw), number=repeat, repeat=3))
+
+    base = timings['requests']
+    print('{0} ({1:.0f} KiB)'.format(name, len(raw) / 1024.0))
+    for codec_name, seconds in sorted(timings.items(), key=lambda item: item[1]):
+        print('  {0:<10} {1:8.3f} ms/page  x{2:.2f}'.format(codec_name, seconds / repeat * 1000, base / seconds))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+
+    for name, page in (('get_messages', messages_page()), ('get_chats', chats_page())):
+        bench(name, util.JSON_CODECS['json'].dumps(page), args.repeat)
+
+
+if __name__ == '__main__':
+    main()
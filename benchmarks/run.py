@@ -0,0 +1,177 @@
+"""
+Benchmark suite for tambotapi against a local stub TamTam server.
+
+    $ PYTHONPATH=. python benchmarks/run.py [--latency 0.02] [--calls 500] [--concurrency 16]
+                                           [--page-size 50] [--output results.json]
+
+Measures throughput and p50/p99 latency of every apihandler function, util.ThreadPool
+dispatch and JSON decoding, and writes the results as JSON (to stdout without --output)
+so runs of different releases can be compared.
+"""
+import argparse
+import json
+import platform
+import sys
+import threading
+import time
+import timeit
+from concurrent import futures
+
+from tambotapi import apihandler, util
+
+from json_codec import chats_page, messages_page
+from stub_server import StubServer
+
+TOKEN = 'bench-token'
+CHAT_ID = -1001
+
+
+def api_calls():
+    """
+    One representative call per apihandler function, by name.
+    """
+    return {
+        'get_bot_info': lambda: apihandler.get_bot_info(TOKEN),
+        'edit_bot_info': lambda: apihandler.edit_bot_info(TOKEN, description='bench'),
+        'get_chats': lambda: apihandler.get_chats(TOKEN, count=50),
+        'get_chat_info': lambda: apihandler.get_chat_info(TOKEN, CHAT_ID),
+        'edit_chat_info': lambda: apihandler.edit_chat_info(TOKEN, CHAT_ID, None, 'bench'),
+        'send_chat_action': lambda: apihandler.send_chat_action(TOKEN, CHAT_ID, 'typing_on'),
+        'get_chat_membership': lambda: apihandler.get_chat_membership(TOKEN, CHAT_ID),
+        'leave_chat': lambda: apihandler.leave_chat(TOKEN, CHAT_ID),
+        'get_chat_admins': lambda: apihandler.get_chat_admins(TOKEN, CHAT_ID),
+        'get_members': lambda: apihandler.get_members(TOKEN, CHAT_ID, count=50),
+        'add_members': lambda: apihandler.add_members(TOKEN, CHAT_ID, [1, 2]),
+        'remove_member': lambda: apihandler.remove_member(TOKEN, CHAT_ID, 1),
+        'get_messages': lambda: apihandler.get_messages(TOKEN, chat_id=CHAT_ID, count=50),
+        'send_message': lambda: apihandler.send_message(TOKEN, chat_id=CHAT_ID, text='bench'),
+        'get_updates': lambda: apihandler.get_updates(TOKEN, timeout=0),
+        'get_subscriptions': lambda: apihandler.get_subscriptions(TOKEN),
+        'subscribe': lambda: apihandler.subscribe(TOKEN, 'https://example.com/hook'),
+        'unsubscribe': lambda: apihandler.unsubscribe(TOKEN, 'https://example.com/hook'),
+        'get_upload_url': lambda: apihandler.get_upload_url(TOKEN, 'file'),
+    }
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarize(latencies, elapsed, **extra):
+    latencies = sorted(latencies)
+    result = {
+        'count': len(latencies),
+        'seconds': round(elapsed, 6),
+        'throughput': round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        'p50_ms': round(percentile(latencies, .50) * 1000, 3),
+        'p99_ms': round(percentile(latencies, .99) * 1000, 3),
+    }
+    result.update(extra)
+    return result
+
+
+def bench_call(call, calls, concurrency):
+    latencies = []
+    lock = threading.Lock()
+
+    def timed():
+        start = time.perf_counter()
+        call()
+        latency = time.perf_counter() - start
+        with lock:
+            latencies.append(latency)
+
+    call()
+    start = time.perf_counter()
+    with futures.ThreadPoolExecutor(concurrency) as executor:
+        for future in [executor.submit(timed) for _ in range(calls)]:
+            future.result()
+    return summarize(latencies, time.perf_counter() - start, concurrency=concurrency)
+
+
+def bench_thread_pool(tasks, num_threads):
+    """
+    Time from ThreadPool.put to the task starting, for `tasks` no-op tasks.
+    """
+    pool = util.ThreadPool(num_threads)
+    latencies = []
+    lock = threading.Lock()
+
+    def task(queued_at):
+        latency = time.perf_counter() - queued_at
+        with lock:
+            latencies.append(latency)
+
+    start = time.perf_counter()
+    for pending in [pool.put(task, time.perf_counter()) for _ in range(tasks)]:
+        pending.result()
+    elapsed = time.perf_counter() - start
+    pool.close()
+    return summarize(latencies, elapsed, num_threads=num_threads)
+
+
+def bench_json(page_size, repeat):
+    results = {}
+    for name, page in (('get_messages', messages_page(page_size)), ('get_chats', chats_page(page_size))):
+        raw = util.JSON_CODECS['json'].dumps(page)
+        for codec in util.JSON_CODECS.values():
+            seconds = min(timeit.repeat(lambda: codec.loads(raw), number=repeat, repeat=3)) / repeat
+            results['{0}.{1}'.format(name, codec.name)] = {
+                'bytes': len(raw),
+                'ms_per_page': round(seconds * 1000, 4),
+                'mb_per_second': round(len(raw) / seconds / 1e6, 2),
+            }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--latency', type=float, default=0.0, help='stub server latency in seconds')
+    parser.add_argument('--calls', type=int, default=500, help='calls per apihandler function')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--page-size', type=int, default=50)
+    parser.add_argument('--text-size', type=int, default=200)
+    parser.add_argument('--tasks', type=int, default=20000, help='tasks for the ThreadPool benchmark')
+    parser.add_argument('--only', nargs='*', help='run only these apihandler functions')
+    parser.add_argument('--output', help='write results to this file instead of stdout')
+    args = parser.parse_args()
+
+    server = StubServer(latency=args.latency, page_size=args.page_size, text_size=args.text_size).start()
+    apihandler.set_api_url(server.url)
+    apihandler.configure_session(pool_maxsize=args.concurrency)
+
+    results = {
+        'meta': {
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'json_codec': util.json_codec.name,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'args': vars(args),
+        },
+        'apihandler': {},
+    }
+    for name, call in sorted(api_calls().items()):
+        if args.only and name not in args.only:
+            continue
+        results['apihandler'][name] = bench_call(call, args.calls, args.concurrency)
+        sys.stderr.write('{0:<20} {1[throughput]:>9} req/s  p50 {1[p50_ms]} ms  p99 {1[p99_ms]} ms\n'.format(
+            name, results['apihandler'][name]))
+    results['pool'] = apihandler.get_pool_stats()
+    results['thread_pool'] = {str(threads): bench_thread_pool(args.tasks, threads) for threads in (1, 4, 16)}
+    results['json'] = bench_json(args.page_size, 20)
+    server.stop()
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
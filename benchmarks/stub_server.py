@@ -0,0 +1,108 @@
+"""
+Local stand-in for botapi.tamtam.chat used by the benchmarks.
+
+Answers every endpoint apihandler knows with synthetic JSON after `latency` seconds.
+List endpoints return `page_size` items, message texts are `text_size` characters long.
+
+    server = StubServer(latency=0.02, page_size=100).start()
+    apihandler.set_api_url(server.url)
+"""
+import re
+import threading
+import time
+from http import server as http_server
+
+from tambotapi import util
+
+from json_codec import chats_page, messages_page
+
+
+class StubServer:
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, page_size=50, text_size=200):
+        self.latency = latency
+        self.page_size = page_size
+        self.text_size = text_size
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.cache = {}
+        self.server = http_server.ThreadingHTTPServer((host, port), _StubRequestHandler)
+        self.server.daemon_threads = True
+        self.server.stub = self
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://{0}:{1}/'.format(*self.server.server_address)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name="StubServer")
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def response(self, verb, path):
+        # Bodies are encoded once per route, the stub should cost as little as possible.
+        key = (verb, route_key(path))
+        body = self.cache.get(key)
+        if body is None:
+            body = self.cache[key] = util.JSON_CODECS['json'].dumps(self.build(verb, path))
+        return body
+
+    def build(self, verb, path):
+        if path == 'me':
+            return {'user_id': 1, 'name': 'Bench Bot', 'username': 'bench_bot', 'commands': []}
+        if path == 'chats':
+            return chats_page(self.page_size)
+        if path == 'messages':
+            if verb == 'POST':
+                return {'message': messages_page(1, self.text_size)['messages'][0]}
+            return messages_page(self.page_size, self.text_size)
+        if path == 'updates':
+            return {'updates': [], 'marker': 1}
+        if path == 'uploads':
+            return {'url': self.url + 'upload'}
+        if re.match(r'chats/-?\d+$', path) and verb == 'GET':
+            return chats_page(1)['chats'][0]
+        if re.match(r'chats/-?\d+/members(/admins)?$', path) and verb == 'GET':
+            return {'members': [{'user_id': 100000 + i, 'name': 'User {0}'.format(i), 'is_admin': False,
+                                 'is_owner': False, 'join_time': 1570000000000, 'last_access_time': 0}
+                                for i in range(self.page_size)], 'marker': None}
+        if re.match(r'chats/-?\d+/members/me$', path):
+            if verb == 'GET':
+                return {'user_id': 1, 'name': 'Bench Bot', 'is_admin': True, 'is_owner': False}
+        return {'success': True}
+
+
+def route_key(path):
+    return re.sub(r'-?\d+', '{id}', path)
+
+
+class _StubRequestHandler(http_server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes, Nagle would hold the body for the delayed ACK.
+    disable_nagle_algorithm = True
+
+    def _handle(self):
+        stub = self.server.stub
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+        with stub.lock:
+            stub.requests += 1
+        if stub.latency:
+            time.sleep(stub.latency)
+        body = stub.response(self.command, self.path.split('?', 1)[0].strip('/'))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = _handle
+
+    def log_message(self, format, *args):
+        pass
@@ -0,0 +1,93 @@
+"""
+Memory and speed of tambotapi.types against plain dicts.
+
+    $ PYTHONPATH=. python benchmarks/types_memory.py [--count N]
+
+Compares, for N parsed `message_created` updates:
+  dicts   the parsed JSON alone
+  lazy    tambotapi.types.Update wrappers, before and after reading update.message.text
+  eager   a conventional object graph (one __dict__ object per nested JSON object),
+          built the way de_json constructors usually do it
+"""
+import argparse
+import time
+import tracemalloc
+
+from tambotapi import types, util
+
+
+def update_json(i):
+    return {
+        'update_type': 'message_created',
+        'timestamp': 1570000000000 + i,
+        'message': {
+            'sender': {'user_id': 100000 + i, 'name': 'User {0}'.format(i), 'username': 'user{0}'.format(i)},
+            'recipient': {'chat_id': -1000 - i % 50, 'chat_type': 'chat', 'user_id': None},
+            'timestamp': 1570000000000 + i,
+            'body': {'mid': 'mid.{0:016x}'.format(i), 'seq': i, 'text': 'message {0}'.format(i),
+                     'attachments': [{'type': 'image', 'payload': {'url': 'https://i.oneme.ru/{0}'.format(i),
+                                                                   'token': 't{0}'.format(i)}}]},
+        },
+    }
+
+
+class Eager(object):
+    def __init__(self, json):
+        for key, value in json.items():
+            if isinstance(value, dict):
+                value = Eager(value)
+            elif isinstance(value, list):
+                value = [Eager(item) if isinstance(item, dict) else item for item in value]
+            setattr(self, key, value)
+
+
+def measure(build):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = build()
+    elapsed = time.perf_counter() - start
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, size, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--count', type=int, default=100000)
+    args = parser.parse_args()
+
+    raw = [util.json_dumps(update_json(i)) for i in range(args.count)]
+
+    dicts, dicts_size, dicts_time = measure(lambda: [util.json_loads(data) for data in raw])
+    lazy, lazy_size, lazy_time = measure(lambda: [types.Update(util.json_loads(data)) for data in raw])
+    _, touched_size, touched_time = measure(lambda: [update.message.text for update in lazy])
+    eager, eager_size, eager_time = measure(lambda: [Eager(util.json_loads(data)) for data in raw])
+
+    start = time.perf_counter()
+    for update in dicts:
+        update['message']['body']['text']
+    dict_access = time.perf_counter() - start
+    start = time.perf_counter()
+    for update in lazy:
+        update.message.text
+    lazy_access = time.perf_counter() - start
+    start = time.perf_counter()
+    for update in eager:
+        update.message.body.text
+    eager_access = time.perf_counter() - start
+
+    per = 1.0 / args.count
+    print('{0} updates, bytes and microseconds per update'.format(args.count))
+    print('  {0:<22} {1:>8} {2:>10} {3:>10}'.format('', 'memory', 'build', 'access'))
+    print('  {0:<22} {1:8.0f} {2:10.2f} {3:10.3f}'.format('dicts', dicts_size * per, dicts_time * per * 1e6,
+                                                          dict_access * per * 1e6))
+    print('  {0:<22} {1:8.0f} {2:10.2f} {3:10.3f}'.format('lazy', lazy_size * per, lazy_time * per * 1e6,
+                                                          lazy_access * per * 1e6))
+    print('  {0:<22} {1:8.0f} {2:10.2f}'.format('lazy, message touched', (lazy_size + touched_size) * per,
+                                                 (lazy_time + touched_time) * per * 1e6))
+    print('  {0:<22} {1:8.0f} {2:10.2f} {3:10.3f}'.format('eager', eager_size * per, eager_time * per * 1e6,
+                                                          eager_access * per * 1e6))
+
+
+if __name__ == '__main__':
+    main()
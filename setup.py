@@ -22,6 +22,9 @@ setup(name='tambotapi',
       install_requires=['requests', 'six'],
       extras_require={
           'json': 'ujson',
+          'orjson': 'orjson',
+          'aiohttp': 'aiohttp',
+          'httpx': 'httpx[http2]',
       },
       classifiers=[
           'Development Status :: 5 - Production/Stable',
@@ -1,14 +1,21 @@
 r"""The Powerful TamTam Bot API Framework"""
 from __future__ import print_function
 
+import hashlib
 import logging
+import mmap
 import os
 import pickle
 import re
 import sys
+import tempfile
 import threading
 import time
 import six
+import socketserver
+from concurrent import futures
+from http import server as http_server
+from urllib.parse import urlsplit
 
 # Logger
 logger = logging.getLogger('tambotapi')
@@ -18,7 +25,7 @@ console_output_handler.setFormatter(log_format)
 logger.addHandler(console_output_handler)
 logger.setLevel(logging.ERROR)
 
-from . import util, apihandler
+from . import util, apihandler, types
 
 """
 Module : telebotapi
@@ -68,16 +75,14 @@ class Saver:
 
     @staticmethod
     def dump_handlers(handlers, filename, file_mode="wb"):
-        dirs = filename.rsplit('/', maxsplit=1)[0]
-        os.makedirs(dirs, exist_ok=True)
+        dirs = os.path.dirname(filename)
+        if dirs:
+            os.makedirs(dirs, exist_ok=True)
 
         with open(filename + ".tmp", file_mode) as file:
-            pickle.dump(handlers, file)
+            pickle.dump(handlers, file, pickle.HIGHEST_PROTOCOL)
 
-        if os.path.isfile(filename):
-            os.remove(filename)
-
-        os.rename(filename + ".tmp", filename)
+        os.replace(filename + ".tmp", filename)
 
     @staticmethod
     def return_load_handlers(filename, del_file_after_loading=True):
@@ -88,4 +93,709 @@ class Saver:
             if del_file_after_loading:
                 os.remove(filename)
 
-            return handlers
\ No newline at end of file
+            return handlers
+
+
+class JournaledSaver(Saver):
+    """
+    Class for saving (next step|reply) handlers incrementally.
+    Changes made through set_handler/delete_handler are appended to `filename + '.journal'` on each
+    timer tick, so a save costs as much as the changes since the last one. Once the journal holds more
+    records than `compact_threshold` (or the number of handlers, if larger) the snapshot in `filename`
+    is rewritten and the journal emptied. recover() loads the snapshot and replays the journal.
+    Each compaction starts a new generation, recorded in the snapshot and at the head of the journal,
+    so a journal left over from before the latest snapshot (a crash while compacting) is not replayed.
+    """
+
+    SNAPSHOT_TAG = 'journaled-snapshot'
+
+    def __init__(self, handlers, filename, delay, compact_threshold=10000):
+        Saver.__init__(self, handlers, filename, delay)
+        self.journal_filename = filename + ".journal"
+        self.compact_threshold = compact_threshold
+        self.journal_records = 0
+        self.generation = 0
+        self.pending = []
+        self.lock = threading.Lock()
+        self.io_lock = threading.Lock()
+
+    def set_handler(self, key, value):
+        with self.lock:
+            self.handlers[key] = value
+            self.pending.append((key, value))
+        self.start_save_timer()
+
+    def delete_handler(self, key):
+        with self.lock:
+            if self.handlers.pop(key, None) is None:
+                return
+            self.pending.append((key, None))
+        self.start_save_timer()
+
+    def save_handlers(self):
+        with self.io_lock:
+            with self.lock:
+                pending, self.pending = self.pending, []
+            if pending:
+                self._append_journal(pending)
+            if self.journal_records > max(self.compact_threshold, len(self.handlers)):
+                self._compact()
+
+    def compact(self):
+        with self.io_lock:
+            with self.lock:
+                pending, self.pending = self.pending, []
+            if pending:
+                self._append_journal(pending)
+            self._compact()
+
+    def _append_journal(self, records):
+        dirs = os.path.dirname(self.journal_filename)
+        if dirs:
+            os.makedirs(dirs, exist_ok=True)
+        with open(self.journal_filename, "ab") as file:
+            if file.tell() == 0:
+                pickle.dump(self.generation, file, pickle.HIGHEST_PROTOCOL)
+            for record in records:
+                pickle.dump(record, file, pickle.HIGHEST_PROTOCOL)
+            file.flush()
+            os.fsync(file.fileno())
+        self.journal_records += len(records)
+
+    def _compact(self):
+        # Records buffered after this copy are also in `pending`; replaying them twice is harmless.
+        # The snapshot may already hold changes newer than the journal on disk, hence the new generation.
+        with self.lock:
+            snapshot = dict(self.handlers)
+        self.generation += 1
+        self.dump_handlers((self.SNAPSHOT_TAG, self.generation, snapshot), self.filename)
+        if os.path.isfile(self.journal_filename):
+            os.remove(self.journal_filename)
+        self.journal_records = 0
+
+    def load_handlers(self, filename, del_file_after_loading=True):
+        generation, handlers = self._load_snapshot(filename, del_file_after_loading)
+        if handlers is not None:
+            self.handlers.update(handlers)
+
+    def _load_snapshot(self, filename, del_file_after_loading=False):
+        # :return: (generation, handlers); plain Saver snapshots are generation 0.
+        snapshot = self.return_load_handlers(filename, del_file_after_loading=del_file_after_loading)
+        if isinstance(snapshot, tuple) and len(snapshot) == 3 and snapshot[0] == self.SNAPSHOT_TAG:
+            return snapshot[1], snapshot[2]
+        return 0, snapshot
+
+    def recover(self):
+        """
+        Rebuilds `handlers` from the snapshot and the journal, then compacts them into a new snapshot.
+        A journal from an older generation than the snapshot is already contained in it and skipped.
+        """
+        generation, snapshot = self._load_snapshot(self.filename)
+        journal_generation = self.journal_generation(self.journal_filename)
+        with self.lock:
+            if snapshot:
+                self.handlers.update(snapshot)
+            if journal_generation is not None and journal_generation >= generation:
+                for key, value in self.read_journal(self.journal_filename):
+                    if value is None:
+                        self.handlers.pop(key, None)
+                    else:
+                        self.handlers[key] = value
+            elif journal_generation is not None:
+                logger.warning("Stale journal {0} (generation {1}, snapshot {2}), ignored".format(
+                    self.journal_filename, journal_generation, generation))
+        self.generation = max(generation, journal_generation or 0)
+        self.compact()
+
+    @classmethod
+    def journal_generation(cls, filename):
+        """
+        :return: the generation at the head of the journal, 0 for journals written without one,
+            None when there is no journal.
+        """
+        for record in cls._read_records(filename):
+            return record if isinstance(record, int) else 0
+        return None
+
+    @classmethod
+    def read_journal(cls, filename):
+        for record in cls._read_records(filename):
+            if not isinstance(record, int):
+                yield record
+
+    @staticmethod
+    def _read_records(filename):
+        if not os.path.isfile(filename):
+            return
+        with open(filename, "rb") as file:
+            while True:
+                try:
+                    yield pickle.load(file)
+                except EOFError:
+                    return
+                except (pickle.UnpicklingError, ValueError):
+                    logger.warning("Truncated record at the end of {0}, ignored".format(filename))
+                    return
+
+
+class UpdatePoller:
+    """
+    Class for long polling the `updates` endpoint.
+    A background thread tracks the marker and issues the next poll as soon as
+    a batch arrives, so dispatching a batch overlaps with waiting for the next one.
+    The marker only moves past a batch once it is queued; a batch that arrives after `stop`
+    is kept and queued first on the next `start`. With `typed`, updates are types.Update objects.
+    """
+
+    def __init__(self, token, timeout=30, limit=100, update_types=None, marker=None, max_pending=2,
+                 retry_delay=3, typed=False):
+        self.token = token
+        self.typed = typed
+        self.timeout = timeout
+        self.limit = limit
+        self.update_types = update_types
+        self.marker = marker
+        self.pending = None
+        self.retry_delay = retry_delay
+        self.batches = util.Queue.Queue(maxsize=max_pending)
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.thread is None or not self.thread.is_alive():
+            self.stop_event.clear()
+            self.thread = threading.Thread(target=self._poll, name="UpdatePoller")
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def _poll(self):
+        while not self.stop_event.is_set():
+            if self.pending is not None:
+                updates, marker = self.pending
+                if updates and not self._put_batch(updates):
+                    return
+                self.pending = None
+                if marker is not None:
+                    self.marker = marker
+                continue
+            try:
+                result = apihandler.get_updates(self.token, limit=self.limit, timeout=self.timeout,
+                                                marker=self.marker, update_types=self.update_types)
+            except Exception as e:
+                logger.error("Polling failed: {0}".format(e))
+                self.stop_event.wait(self.retry_delay)
+                continue
+
+            updates = result.get('updates')
+            if updates and self.typed:
+                updates = [types.Update(update) for update in updates]
+            self.pending = (updates, result.get('marker'))
+
+    def _put_batch(self, updates):
+        # Blocks only when `max_pending` batches are waiting, which bounds memory under backlog.
+        while not self.stop_event.is_set():
+            try:
+                self.batches.put(updates, timeout=.5)
+                return True
+            except util.Queue.Full:
+                pass
+        return False
+
+    def iter_batches(self):
+        """
+        Yields batches until `stop` is called and the batches already queued are drained.
+        """
+        self.start()
+        while True:
+            try:
+                yield self.batches.get(timeout=.5)
+            except util.Queue.Empty:
+                if self.stop_event.is_set():
+                    return
+
+    def iter_updates(self):
+        """
+        Streams updates one by one, starting the poller if needed.
+        """
+        for batch in self.iter_batches():
+            for update in batch:
+                yield update
+
+    def polling(self, callback, thread_pool=None):
+        """
+        Dispatches every update to `callback`, through `thread_pool` (a util.ThreadPool) when given.
+        Blocks until `stop` is called.
+        """
+        for batch in self.iter_batches():
+            for update in batch:
+                if thread_pool:
+                    thread_pool.put(callback, update)
+                else:
+                    callback(update)
+
+
+class Broadcaster:
+    """
+    Class for sending the same message to many chats (or users, with recipient_type='user_id').
+    Sends fan out over `max_workers` threads. Every delivered id is appended to the `checkpoint`
+    file, so running the same broadcast again after a crash skips them.
+    `progress_callback` is called with the stats dict at most every `progress_interval` seconds.
+    """
+
+    def __init__(self, token, recipients, text=None, attachments=None, link=None, notify=None,
+                 recipient_type='chat_id', max_workers=16, checkpoint=None, progress_callback=None,
+                 progress_interval=1.0):
+        if recipient_type not in ('chat_id', 'user_id'):
+            raise ValueError("recipient_type must be 'chat_id' or 'user_id'")
+        self.token = token
+        self.recipients = recipients
+        self.message = {'text': text, 'attachments': attachments, 'link': link, 'notify': notify}
+        self.recipient_type = recipient_type
+        self.max_workers = max_workers
+        self.checkpoint = checkpoint
+        self.progress_callback = progress_callback
+        self.progress_interval = progress_interval
+
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.errors = {}
+        self.stats = {'sent': 0, 'failed': 0, 'skipped': 0, 'elapsed': 0.0, 'rate': 0.0}
+        self.started_at = None
+        self.reported_at = 0.0
+        self.checkpoint_file = None
+
+    def load_checkpoint(self):
+        done = set()
+        if self.checkpoint and os.path.isfile(self.checkpoint):
+            with open(self.checkpoint) as file:
+                done.update(line.strip() for line in file if line.strip())
+        return done
+
+    def run(self):
+        """
+        Sends to every recipient not in the checkpoint, blocks until done or stopped.
+        :return: the final stats dict.
+        """
+        done = self.load_checkpoint()
+        if self.checkpoint:
+            self.checkpoint_file = open(self.checkpoint, 'a')
+        self.started_at = time.monotonic()
+        # Bounds queued sends so huge recipient iterables are consumed lazily.
+        slots = threading.BoundedSemaphore(self.max_workers * 2)
+        executor = futures.ThreadPoolExecutor(self.max_workers)
+        try:
+            for recipient in self.recipients:
+                if self.stop_event.is_set():
+                    break
+                if str(recipient) in done:
+                    self._count('skipped')
+                    continue
+                slots.acquire()
+                future = executor.submit(self._send, recipient)
+                future.add_done_callback(lambda _: slots.release())
+        finally:
+            executor.shutdown(wait=True)
+            if self.checkpoint_file:
+                self.checkpoint_file.close()
+                self.checkpoint_file = None
+        self._report(force=True)
+        return dict(self.stats)
+
+    def stop(self):
+        self.stop_event.set()
+
+    def _send(self, recipient):
+        try:
+            result = apihandler.send_message(self.token, **dict(self.message, **{self.recipient_type: recipient}))
+            if isinstance(result, futures.Future):
+                result.result()
+        except Exception as e:
+            logger.error("Broadcast to {0} failed: {1}".format(recipient, e))
+            with self.lock:
+                self.errors[recipient] = e
+            self._count('failed')
+        else:
+            with self.lock:
+                if self.checkpoint_file:
+                    self.checkpoint_file.write('{0}\n'.format(recipient))
+                    self.checkpoint_file.flush()
+            self._count('sent')
+        self._report()
+
+    def _count(self, field):
+        with self.lock:
+            self.stats[field] += 1
+
+    def _report(self, force=False):
+        now = time.monotonic()
+        with self.lock:
+            if not force and now - self.reported_at < self.progress_interval:
+                return
+            self.reported_at = now
+            elapsed = now - self.started_at
+            self.stats['elapsed'] = elapsed
+            self.stats['rate'] = self.stats['sent'] / elapsed if elapsed else 0.0
+            stats = dict(self.stats)
+        if self.progress_callback:
+            self.progress_callback(stats)
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, http_server.HTTPServer):
+    # http.server.ThreadingHTTPServer needs Python 3.7.
+    daemon_threads = True
+
+
+class WebhookReceiver:
+    """
+    Class for receiving updates pushed by the `subscriptions` endpoint.
+    Runs a threaded HTTP server on (host, port), subscribes `url` on start and unsubscribes on stop.
+    Each update is acknowledged with 200 right away and then handed to `callback` through
+    `thread_pool` (a util.ThreadPool), or queued for iter_updates when no callback is given.
+    Only POSTs to `path` are accepted; pass an `ssl_context` to serve HTTPS directly.
+    Bodies without a valid Content-Length get 400, bodies over `max_body_size` bytes 413.
+    With `typed`, updates are types.Update objects.
+    """
+
+    def __init__(self, token, url, callback=None, host='0.0.0.0', port=8443, path='/', thread_pool=None,
+                 update_types=None, ssl_context=None, typed=False, max_body_size=1 << 20):
+        self.token = token
+        self.typed = typed
+        self.max_body_size = max_body_size
+        self.url = url
+        self.callback = callback
+        self.path = path
+        self.thread_pool = thread_pool
+        self.update_types = update_types
+        self.updates = util.Queue.Queue()
+        self.stop_event = threading.Event()
+
+        self.server = _ThreadingHTTPServer((host, port), _WebhookRequestHandler)
+        self.server.receiver = self
+        if ssl_context:
+            self.server.socket = ssl_context.wrap_socket(self.server.socket, server_side=True)
+        self.thread = None
+
+    @property
+    def server_address(self):
+        return self.server.server_address
+
+    def start(self, subscribe=True):
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.server.serve_forever, name="WebhookReceiver")
+        self.thread.daemon = True
+        self.thread.start()
+        if subscribe:
+            apihandler.subscribe(self.token, self.url, update_types=self.update_types)
+
+    def stop(self, unsubscribe=True):
+        self.stop_event.set()
+        try:
+            if unsubscribe:
+                apihandler.unsubscribe(self.token, self.url)
+        finally:
+            self._close_server()
+
+    def _close_server(self):
+        # shutdown() waits for serve_forever, which never returns if it never ran.
+        if self.thread is not None and self.thread.is_alive():
+            self.server.shutdown()
+        self.server.server_close()
+
+    def process_update(self, update):
+        if self.typed:
+            update = types.Update(update)
+        if self.callback is None:
+            self.updates.put(update)
+        elif self.thread_pool:
+            self.thread_pool.put(self.callback, update)
+        else:
+            self.callback(update)
+
+    def iter_updates(self):
+        while not self.stop_event.is_set():
+            try:
+                yield self.updates.get(timeout=.5)
+            except util.Queue.Empty:
+                pass
+
+
+class _WebhookRequestHandler(http_server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        receiver = self.server.receiver
+        if self.path.split('?', 1)[0] != receiver.path:
+            self._reply(404, close=True)
+            return
+        try:
+            length = int(self.headers.get('Content-Length'))
+        except (TypeError, ValueError):
+            length = -1
+        if length < 0:
+            self._reply(400, close=True)
+            return
+        if length > receiver.max_body_size:
+            self._reply(413, close=True)
+            return
+        body = self.rfile.read(length)
+        try:
+            update = util.json_loads(body)
+        except ValueError:
+            self._reply(400)
+            return
+        # Acknowledge before dispatching so a slow handler never delays the server.
+        self._reply(200)
+        receiver.process_update(update)
+
+    def _reply(self, code, close=False):
+        # Close when the request body was left unread, it would be taken for the next request.
+        self.send_response(code)
+        self.send_header('Content-Length', '0')
+        if close:
+            self.send_header('Connection', 'close')
+            self.close_connection = True
+        self.end_headers()
+        self.wfile.flush()
+
+    def log_message(self, format, *args):
+        logger.debug("Webhook: " + format % args)
+
+
+class MetricsServer:
+    """
+    Serves `metrics` (a util.Metrics) in the Prometheus text format on GET `path`
+    from a background HTTP server on (host, port).
+    """
+
+    def __init__(self, metrics, host='0.0.0.0', port=9464, path='/metrics'):
+        self.metrics = metrics
+        self.path = path
+        self.server = _ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+        self.server.exporter = self
+        self.thread = None
+
+    @property
+    def server_address(self):
+        return self.server.server_address
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name="MetricsServer")
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.thread is not None and self.thread.is_alive():
+            self.server.shutdown()
+        self.server.server_close()
+
+
+class _MetricsRequestHandler(http_server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        exporter = self.server.exporter
+        if self.path.split('?', 1)[0] != exporter.path:
+            body = b''
+            self.send_response(404)
+        else:
+            body = exporter.metrics.render().encode('utf8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("Metrics: " + format % args)
+
+
+class Uploader:
+    """
+    Class for uploading attachments concurrently and at most once per content.
+    Files are streamed from disk by apihandler.upload_file on `max_workers` threads. Payloads are
+    cached by (SHA-256 of the file, upload type) in `cache` (a util.TTLCache, one day by default),
+    and concurrent uploads of the same content wait for a single request.
+    """
+
+    def __init__(self, token, max_workers=4, cache=None):
+        self.token = token
+        self.executor = futures.ThreadPoolExecutor(max_workers)
+        self.cache = cache if cache is not None else util.TTLCache(maxsize=10000, ttl=24 * 3600)
+        self.in_flight = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def file_hash(path, chunk_size=apihandler.UPLOAD_CHUNK_SIZE):
+        digest = hashlib.sha256()
+        with open(path, 'rb') as file:
+            if os.fstat(file.fileno()).st_size:
+                with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    for offset in range(0, len(mapped), chunk_size):
+                        digest.update(mapped[offset:offset + chunk_size])
+        return digest.hexdigest()
+
+    def submit(self, path, upload_type='file'):
+        """
+        Uploads in the background, returns a Future of the attachment dict.
+        """
+        return self.executor.submit(self.upload, path, upload_type)
+
+    def upload(self, path, upload_type='file'):
+        """
+        :return: an attachment dict for send_message, {'type': upload_type, 'payload': ...}
+        """
+        key = (self.file_hash(path), upload_type)
+        with self.lock:
+            found, attachment = self.cache.get(key)
+            if found:
+                return attachment
+            future = self.in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = self.in_flight[key] = futures.Future()
+        if not owner:
+            return future.result()
+
+        try:
+            attachment = {'type': upload_type, 'payload': apihandler.upload_file(self.token, path, upload_type)}
+            self.cache.set(key, attachment)
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(attachment)
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+        return attachment
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+class Downloader:
+    """
+    Class for downloading attachments to disk through apihandler.transport (see set_transport).
+    Bodies are streamed to a unique `.part` file next to `path`, renamed when complete and
+    removed when the download fails. Files of at least
+    `range_threshold` bytes from servers accepting byte ranges are fetched as parallel ranges of
+    `part_size` bytes, each written at its offset. At most `per_host` requests (ranges included)
+    run against one host at a time.
+    """
+
+    def __init__(self, max_workers=8, per_host=4, range_threshold=8 << 20, part_size=4 << 20, chunk_size=64 << 10):
+        self.executor = futures.ThreadPoolExecutor(max_workers)
+        self.part_executor = futures.ThreadPoolExecutor(max_workers * per_host)
+        self.per_host = per_host
+        self.range_threshold = range_threshold
+        self.part_size = part_size
+        self.chunk_size = chunk_size
+        self.hosts = {}
+        self.lock = threading.Lock()
+
+    def _host_slots(self, url):
+        host = urlsplit(url).netloc
+        with self.lock:
+            slots = self.hosts.get(host)
+            if slots is None:
+                slots = self.hosts[host] = threading.BoundedSemaphore(self.per_host)
+            return slots
+
+    def _get(self, url, headers=None):
+        result = apihandler.transport.stream('get', url, headers=headers,
+                                             timeout=(apihandler.CONNECT_TIMEOUT, apihandler.READ_TIMEOUT))
+        if result.status_code >= 400:
+            result.close()
+            raise apihandler.ApiException('Download returned HTTP {0}'.format(result.status_code), 'download', result)
+        return result
+
+    def submit(self, url, path):
+        """
+        Downloads in the background, returns a Future of `path`.
+        """
+        return self.executor.submit(self.download, url, path)
+
+    def download(self, url, path):
+        slots = self._host_slots(url)
+        with slots:
+            with apihandler.transport.stream('head', url, timeout=(apihandler.CONNECT_TIMEOUT,
+                                                                   apihandler.READ_TIMEOUT)) as head:
+                pass
+        size = int(head.headers.get('Content-Length') or 0) if head.status_code < 400 else 0
+        fd, tmp_path = tempfile.mkstemp(suffix='.part', prefix=os.path.basename(path) + '.',
+                                        dir=os.path.dirname(path) or '.')
+        os.close(fd)
+        try:
+            if size >= self.range_threshold and head.headers.get('Accept-Ranges') == 'bytes':
+                self._download_ranges(head.url or url, tmp_path, size, slots)
+            else:
+                with slots:
+                    self._download_stream(url, tmp_path)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        return path
+
+    def _download_stream(self, url, path):
+        with self._get(url) as result, open(path, 'wb') as file:
+            for chunk in result.iter_content(self.chunk_size):
+                file.write(chunk)
+
+    def _download_ranges(self, url, path, size, slots):
+        with open(path, 'wb') as file:
+            file.truncate(size)
+        parts = [self.part_executor.submit(self._download_range, url, path, start,
+                                           min(start + self.part_size, size) - 1, slots)
+                 for start in range(0, size, self.part_size)]
+        try:
+            for part in parts:
+                part.result()
+        except BaseException:
+            # Let running parts finish before the caller removes the file under them.
+            for part in parts:
+                part.cancel()
+            futures.wait(parts)
+            raise
+
+    def _download_range(self, url, path, start, end, slots):
+        with slots:
+            with self._get(url, {'Range': 'bytes={0}-{1}'.format(start, end)}) as result:
+                if result.status_code != 206:
+                    raise apihandler.ApiException('Range request returned HTTP {0}'.format(result.status_code),
+                                                  'download', result)
+                with open(path, 'r+b') as file:
+                    file.seek(start)
+                    for chunk in result.iter_content(self.chunk_size):
+                        file.write(chunk)
+
+    def download_attachments(self, messages, directory):
+        """
+        Downloads every attachment with a URL in `messages` (as returned by get_messages) into
+        `directory`, named by the attachment filename or by message id and position. Repeated
+        filenames are prefixed with the message id and position to keep them apart.
+        :return: a list of Futures of the file paths.
+        """
+        os.makedirs(directory, exist_ok=True)
+        downloads = []
+        names = set()
+        for message in messages:
+            body = message.get('body') or {}
+            for index, attachment in enumerate(body.get('attachments') or ()):
+                url = (attachment.get('payload') or {}).get('url')
+                if not url:
+                    continue
+                filename = os.path.basename(attachment.get('filename') or '')
+                if not filename or filename in names:
+                    filename = '{0}_{1}{2}'.format(body.get('mid'), index, '_' + filename if filename else '')
+                names.add(filename)
+                downloads.append(self.submit(url, os.path.join(directory, filename)))
+        return downloads
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.part_executor.shutdown(wait=True)
@@ -1,5 +1,21 @@
+import base64
+import collections
+import logging
+import mmap
+import os
 import requests
-import json
+import string
+import threading
+import time
+from concurrent import futures
+from urllib.parse import urlsplit
+from uuid import uuid4
+from requests.packages.urllib3 import connectionpool
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
 
 try:
     from requests.packages.urllib3 import fields
@@ -9,81 +25,716 @@ except ImportError:
     format_header_param = None
 
 import tambotapi
-#from tambotapi import types
+from tambotapi import types
 from tambotapi import util
 
+API_URL = 'https://botapi.tamtam.chat/'
 CONNECT_TIMEOUT = 3.5
-READ_TIMEOUT = 9999
+READ_TIMEOUT = 30
+# Server-side wait of get_updates when no `timeout` is passed.
+LONG_POLL_TIMEOUT = 30
+
+JSON_HEADERS = {'Content-Type': 'application/json'}
+IDEMPOTENT_VERBS = ('get', 'put', 'delete')
+
+UPLOAD_CHUNK_SIZE = 1 << 20
+# Default and maximum `count` of get_messages.
+MESSAGES_PAGE_DEFAULT = 50
+MESSAGES_PAGE_LIMIT = 100
 
 logger = tambotapi.logger
 proxy = None
+rate_limiter = None
+response_cache = None
+singleflight = None
+metrics = None
+retry_policy = util.RetryPolicy()
+
+
+class PoolStats:
+    """
+    Thread-safe counters for the shared connection pool.
+    pool_hits: requests served on an already open keep-alive connection.
+    pool_misses: requests that had to open a connection (new, dropped or expired).
+    connections_created: TCP (and TLS) connections opened.
+    connections_expired: idle connections closed for exceeding the keep-alive timeout.
+    """
+
+    FIELDS = ('pool_hits', 'pool_misses', 'connections_created', 'connections_expired')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = dict.fromkeys(self.FIELDS, 0)
+
+    def incr(self, field):
+        with self.lock:
+            self.counters[field] += 1
+
+    def reset(self):
+        with self.lock:
+            self.counters = dict.fromkeys(self.FIELDS, 0)
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counters)
+
+
+class SessionManager:
+    """
+    Process-wide requests.Session shared by every thread.
+    pool_maxsize: connections kept alive per host, size it to the number of worker threads.
+    pool_connections: number of per-host pools to cache.
+    pool_block: wait for a free connection instead of opening one beyond `pool_maxsize`.
+    keepalive_timeout: seconds a connection may sit idle in the pool before it is closed
+        and re-opened on next use, None keeps it until the server drops it.
+    """
+
+    def __init__(self, pool_connections=10, pool_maxsize=10, pool_block=False, keepalive_timeout=None):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.pool_block = pool_block
+        self.keepalive_timeout = keepalive_timeout
+        self.stats = PoolStats()
+        self.pool_classes = {'http': self._pool_class(connectionpool.HTTPConnectionPool),
+                             'https': self._pool_class(connectionpool.HTTPSConnectionPool)}
+        self.lock = threading.Lock()
+        self.session = None
+
+    def _pool_class(self, base):
+        manager = self
+
+        class Connection(base.ConnectionCls):
+            def connect(self):
+                manager.stats.incr('connections_created')
+                return super(Connection, self).connect()
+
+        class Pool(base):
+            ConnectionCls = Connection
+
+            def _get_conn(self, timeout=None):
+                conn = super(Pool, self)._get_conn(timeout)
+                return manager._checkout(conn)
+
+            def _put_conn(self, conn):
+                if conn is not None:
+                    conn.released_at = time.monotonic()
+                super(Pool, self)._put_conn(conn)
+
+        return Pool
+
+    def _checkout(self, conn):
+        released_at = getattr(conn, 'released_at', None)
+        if (self.keepalive_timeout is not None and released_at is not None and conn.sock is not None
+                and time.monotonic() - released_at > self.keepalive_timeout):
+            conn.close()
+            self.stats.incr('connections_expired')
+        self.stats.incr('pool_hits' if conn.sock is not None else 'pool_misses')
+        return conn
+
+    def _new_session(self):
+        session = requests.Session()
+        for prefix in ('http://', 'https://'):
+            session.mount(prefix, _PoolAdapter(self, pool_connections=self.pool_connections,
+                                               pool_maxsize=self.pool_maxsize, pool_block=self.pool_block))
+        return session
+
+    def get_session(self, reset=False):
+        if self.session is None or reset:
+            with self.lock:
+                if self.session is None or reset:
+                    old, self.session = self.session, self._new_session()
+                    if old is not None:
+                        old.close()
+        return self.session
+
+    def configure(self, pool_connections=None, pool_maxsize=None, pool_block=None, keepalive_timeout=None):
+        """
+        Changes pool settings, the session is rebuilt on next use.
+        """
+        if pool_connections is not None:
+            self.pool_connections = pool_connections
+        if pool_maxsize is not None:
+            self.pool_maxsize = pool_maxsize
+        if pool_block is not None:
+            self.pool_block = pool_block
+        if keepalive_timeout is not None:
+            self.keepalive_timeout = keepalive_timeout
+        self.close()
+
+    def close(self):
+        with self.lock:
+            if self.session is not None:
+                self.session.close()
+            self.session = None
+
+
+class _PoolAdapter(requests.adapters.HTTPAdapter):
+    def __init__(self, manager, **kwargs):
+        self.manager = manager
+        super(_PoolAdapter, self).__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super(_PoolAdapter, self).init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = self.manager.pool_classes
+
+
+session_manager = SessionManager()
+
+
+def configure_session(pool_connections=None, pool_maxsize=None, pool_block=None, keepalive_timeout=None):
+    session_manager.configure(pool_connections, pool_maxsize, pool_block, keepalive_timeout)
+
+
+def get_pool_stats():
+    return session_manager.stats.snapshot()
 
 
 def _get_req_session(reset=False):
-    return util.per_thread('req_session', lambda: requests.session(), reset)
+    return session_manager.get_session(reset)
+
+
+class Transport:
+    """
+    Sends the HTTP requests of every apihandler function, see set_transport.
+    request() returns an object with status_code, reason, headers, content and text
+    (a requests.Response or a TransportResponse) and signals network failures with
+    requests.exceptions.RequestException subclasses, which drive retries and circuit breakers.
+    stream() serves downloads (see tambotapi.Downloader): it follows redirects and its result
+    also has url, iter_content(chunk_size) and close(), and is a context manager.
+     timeout: a (connect, read) pair of seconds.
+    """
+
+    def request(self, method, url, params=None, data=None, headers=None, files=None, timeout=None):
+        raise NotImplementedError
+
+    def stream(self, method, url, headers=None, timeout=None):
+        # Transports without streaming read the whole body.
+        return self.request(method, url, headers=headers, timeout=timeout)
+
+    def close(self):
+        pass
+
+
+class TransportResponse:
+    def __init__(self, status_code, reason, headers, content, url=None):
+        self.status_code = status_code
+        self.reason = reason
+        self.headers = requests.structures.CaseInsensitiveDict(headers)
+        self.content = content
+        self.url = url
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', 'replace')
+
+    def iter_content(self, chunk_size=1):
+        for offset in range(0, len(self.content), chunk_size):
+            yield self.content[offset:offset + chunk_size]
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class RequestsTransport(Transport):
+    """
+    The default transport: the pooled requests.Session of `session_manager`.
+    Uses the module-level `proxy` unless `proxies` is given.
+    """
+
+    def __init__(self, proxies=None):
+        self.proxies = proxies
+
+    def request(self, method, url, params=None, data=None, headers=None, files=None, timeout=None):
+        return _get_req_session().request(method, url, params=params, data=data, headers=headers, files=files,
+                                          timeout=timeout, proxies=self.proxies or proxy)
+
+    def stream(self, method, url, headers=None, timeout=None):
+        return _get_req_session().request(method, url, headers=headers, stream=True, allow_redirects=True,
+                                          timeout=timeout, proxies=self.proxies or proxy)
+
+    def close(self):
+        session_manager.close()
+
+
+class HttpxTransport(Transport):
+    """
+    Multiplexes concurrent requests over HTTP/2 connections with an httpx.Client,
+    needs the httpx and h2 packages (tambotapi[httpx]).
+    httpx errors are raised as the matching requests exceptions.
+    """
+
+    def __init__(self, http2=True, max_connections=10, proxy=None):
+        if httpx is None:
+            raise ImportError('httpx is required for HttpxTransport, install tambotapi[httpx]')
+        self.client = httpx.Client(http2=http2, proxy=proxy, limits=httpx.Limits(max_connections=max_connections))
+
+    def request(self, method, url, params=None, data=None, headers=None, files=None, timeout=None):
+        connect, read = timeout or (CONNECT_TIMEOUT, READ_TIMEOUT)
+        if files:
+            kwargs = {'files': files}
+        else:
+            kwargs = {'content': data}
+        try:
+            result = self.client.request(method, url, params=params, headers=headers,
+                                         timeout=httpx.Timeout(read, connect=connect), **kwargs)
+        except httpx.TimeoutException as e:
+            raise requests.exceptions.Timeout(str(e))
+        except httpx.TransportError as e:
+            raise requests.exceptions.ConnectionError(str(e))
+        return TransportResponse(result.status_code, result.reason_phrase, result.headers, result.content)
+
+    def stream(self, method, url, headers=None, timeout=None):
+        connect, read = timeout or (CONNECT_TIMEOUT, READ_TIMEOUT)
+        request = self.client.build_request(method, url, headers=headers, timeout=httpx.Timeout(read, connect=connect))
+        try:
+            return _HttpxStream(self.client.send(request, stream=True, follow_redirects=True))
+        except httpx.TimeoutException as e:
+            raise requests.exceptions.Timeout(str(e))
+        except httpx.TransportError as e:
+            raise requests.exceptions.ConnectionError(str(e))
+
+    def close(self):
+        self.client.close()
+
+
+class _HttpxStream(TransportResponse):
+    def __init__(self, result):
+        TransportResponse.__init__(self, result.status_code, result.reason_phrase, result.headers, None,
+                                   str(result.url))
+        self.result = result
+
+    def iter_content(self, chunk_size=1):
+        try:
+            for chunk in self.result.iter_bytes(chunk_size):
+                yield chunk
+        except httpx.TimeoutException as e:
+            raise requests.exceptions.Timeout(str(e))
+        except httpx.TransportError as e:
+            raise requests.exceptions.ConnectionError(str(e))
+
+    def close(self):
+        self.result.close()
+
+
+class ReplayMissError(LookupError):
+    """
+    Raised by ReplayTransport for a request that is not in the recording.
+    """
+
+
+def _recording_key(method, url, params, data, headers):
+    # The access token is never part of a key nor written to a recording.
+    params = sorted((key, str(value)) for key, value in (params or {}).items() if key != 'access_token')
+    body = data.decode('utf-8', 'replace') if isinstance(data, bytes) else None
+    return method.upper(), urlsplit(url).path, tuple(params), body, (headers or {}).get('Range')
+
+
+class RecordingTransport(Transport):
+    """
+    Sends requests through `transport` (default: RequestsTransport) and appends every
+    response to the JSON lines file at `path`, for replaying it with ReplayTransport.
+    """
+
+    def __init__(self, path, transport=None):
+        self.path = path
+        self.transport = transport or RequestsTransport()
+        self.lock = threading.Lock()
+
+    def request(self, method, url, params=None, data=None, headers=None, files=None, timeout=None):
+        result = self.transport.request(method, url, params=params, data=data, headers=headers, files=files,
+                                        timeout=timeout)
+        method, path, params, body, byte_range = _recording_key(method, url, params, data, headers)
+        line = util.json_dumps({'method': method, 'path': path, 'params': params, 'body': body, 'range': byte_range,
+                                'status_code': result.status_code, 'reason': result.reason,
+                                'headers': dict(result.headers),
+                                'content': base64.b64encode(result.content).decode('ascii')})
+        with self.lock:
+            with open(self.path, 'ab') as file:
+                file.write(line + b'\n')
+        return result
+
+    def close(self):
+        self.transport.close()
+
+
+class ReplayTransport(Transport):
+    """
+    Serves the responses recorded by RecordingTransport at `path` without touching the network.
+    Requests match on method, URL path, query string (the access token left out), JSON body
+    and Range header.
+    Repeated requests get the recorded responses in order, the last one once they run out.
+    A request never recorded raises ReplayMissError.
+    """
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.responses = collections.defaultdict(list)
+        self.served = collections.Counter()
+        with open(path, 'rb') as file:
+            for line in file:
+                if not line.strip():
+                    continue
+                entry = util.json_loads(line)
+                key = (entry['method'], entry['path'], tuple(tuple(pair) for pair in entry['params']), entry['body'],
+                       entry.get('range'))
+                self.responses[key].append(TransportResponse(entry['status_code'], entry['reason'], entry['headers'],
+                                                             base64.b64decode(entry['content'])))
+
+    def request(self, method, url, params=None, data=None, headers=None, files=None, timeout=None):
+        key = _recording_key(method, url, params, data, headers)
+        responses = self.responses.get(key)
+        if not responses:
+            raise ReplayMissError('No recorded response for {0} {1} params={2}'.format(*key[:3]))
+        with self.lock:
+            index = min(self.served[key], len(responses) - 1)
+            self.served[key] += 1
+        response = responses[index]
+        return TransportResponse(response.status_code, response.reason, response.headers, response.content, url)
+
+
+transport = RequestsTransport()
+
+
+def set_transport(new_transport):
+    """
+    Sends every API request, upload and Downloader fetch through `new_transport` (a Transport),
+    None restores the default RequestsTransport. The previous transport is returned, not closed.
+    """
+    global transport
+    previous = transport
+    transport = new_transport or RequestsTransport()
+    return previous
+
+
+class Endpoint:
+    """
+    Describes one TamTam API endpoint: HTTP verb, path template and which call arguments
+    go to the query string and which to the JSON body.
+    `params` and `body` are tuples of argument names, or (argument name, API name) pairs.
+    Hooks are called as hook(endpoint, request) before the request is sent and may modify
+    the `request` dict (keys: url, params, body).
+    rate_limited: calls go through `rate_limiter`, keyed by their chat_id or user_id.
+    idempotent: transient failures are retried, defaults to True for get, put and delete.
+    Every endpoint has its own circuit breaker.
+    cached: results are kept in `response_cache`, keyed by token and chat_id.
+    invalidates: names of cached endpoints whose entry for the same chat a call drops.
+    read_timeout: seconds to wait for the response, defaults to READ_TIMEOUT.
+    long_poll: the server holds the call for its `timeout` argument, the read timeout follows it.
+    """
+
+    def __init__(self, name, verbs, path, params=(), body=(), hooks=None, rate_limited=False, idempotent=None,
+                 cached=False, invalidates=(), read_timeout=None, long_poll=False):
+        self.name = name
+        self.verbs = verbs
+        self.path = path
+        self.rate_limited = rate_limited
+        self.cached = cached
+        self.invalidates = invalidates
+        self.read_timeout = read_timeout
+        self.long_poll = long_poll
+        self.idempotent = verbs in IDEMPOTENT_VERBS if idempotent is None else idempotent
+        self.breaker = util.CircuitBreaker()
+        self.params = tuple(_arg_pair(arg) for arg in params)
+        self.body = tuple(_arg_pair(arg) for arg in body)
+        self.hooks = list(hooks or [])
+        self.path_args = tuple(field for _, field, _, _ in string.Formatter().parse(path) if field)
+        self.compile()
+
+    def compile(self):
+        # Static paths are formatted once, templated ones keep a bound format method.
+        url = API_URL + self.path
+        self.url = None if self.path_args else url
+        self.url_format = url.format
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def prepare(self, token, kwargs):
+        """
+        Builds the request dict for a call with `kwargs`. None values are left out.
+        """
+        url = self.url or self.url_format(**{arg: kwargs[arg] for arg in self.path_args})
+        params = {'access_token': token}
+        for arg, key in self.params:
+            value = kwargs.get(arg)
+            if value is not None:
+                params[key] = _encode_param(value)
+        body = None
+        if self.body:
+            body = {}
+            for arg, key in self.body:
+                value = kwargs.get(arg)
+                if value is not None:
+                    body[key] = value
+        request = {'url': url, 'params': params, 'body': body}
+        for hook in self.hooks:
+            hook(self, request)
+        return request
+
+
+def _arg_pair(arg):
+    return (arg, arg) if util.is_string(arg) else arg
+
+
+def _encode_param(value):
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (list, tuple)):
+        return ','.join(str(v) for v in value)
+    return value
+
+
+ENDPOINTS = {endpoint.name: endpoint for endpoint in (
+    Endpoint('get_bot_info', 'get', 'me', cached=True),
+    Endpoint('edit_bot_info', 'patch', 'me', body=('name', 'username', 'description', 'commands', 'photo'),
+             invalidates=('get_bot_info',)),
+    Endpoint('get_chats', 'get', 'chats', params=('count', 'marker')),
+    Endpoint('get_chat_info', 'get', 'chats/{chat_id}', cached=True),
+    Endpoint('edit_chat_info', 'patch', 'chats/{chat_id}', body=('icon', 'title'), invalidates=('get_chat_info',)),
+    Endpoint('send_chat_action', 'post', 'chats/{chat_id}/actions', body=('action',), rate_limited=True),
+    Endpoint('get_chat_membership', 'get', 'chats/{chat_id}/members/me', cached=True),
+    Endpoint('leave_chat', 'delete', 'chats/{chat_id}/members/me',
+             invalidates=('get_chat_info', 'get_chat_membership', 'get_chat_admins')),
+    Endpoint('get_chat_admins', 'get', 'chats/{chat_id}/members/admins', cached=True),
+    Endpoint('get_members', 'get', 'chats/{chat_id}/members', params=('user_ids', 'marker', 'count')),
+    Endpoint('add_members', 'post', 'chats/{chat_id}/members', body=('user_ids',), rate_limited=True,
+             invalidates=('get_chat_info', 'get_chat_admins')),
+    Endpoint('remove_member', 'delete', 'chats/{chat_id}/members', params=('user_id',), rate_limited=True,
+             invalidates=('get_chat_info', 'get_chat_admins')),
+    Endpoint('get_messages', 'get', 'messages',
+             params=('chat_id', 'message_ids', ('chat_from', 'from'), 'to', 'count')),
+    Endpoint('send_message', 'post', 'messages', params=('chat_id', 'user_id'),
+             body=('text', 'attachments', 'link', 'notify'), rate_limited=True),
+    Endpoint('get_updates', 'get', 'updates', params=('limit', 'timeout', 'marker', ('update_types', 'types')),
+             long_poll=True),
+    Endpoint('get_subscriptions', 'get', 'subscriptions'),
+    Endpoint('subscribe', 'post', 'subscriptions', body=('url', 'update_types', 'version')),
+    Endpoint('unsubscribe', 'delete', 'subscriptions', params=('url',)),
+    Endpoint('get_upload_url', 'post', 'uploads', params=(('upload_type', 'type'),)),
+)}
+
+
+def set_api_url(url):
+    """
+    Points every endpoint at `url` (e.g. a local stand-in server), recompiling the table.
+    """
+    global API_URL
+    API_URL = url if url.endswith('/') else url + '/'
+    for endpoint in ENDPOINTS.values():
+        endpoint.compile()
+
+
+def _read_timeout(endpoint, params):
+    # Long polling calls must outlive their server-side `timeout`.
+    if endpoint.long_poll:
+        return int(params.get('timeout', LONG_POLL_TIMEOUT)) + 10
+    return endpoint.read_timeout or READ_TIMEOUT
+
+
+def set_rate_limiter(limiter):
+    """
+    Installs a util.RateLimiter for the rate limited endpoints (send_message, send_chat_action,
+    add_members, remove_member), None disables limiting.
+    In 'queue' mode those functions return a concurrent.futures.Future instead of the result.
+    """
+    global rate_limiter
+    rate_limiter = limiter
+
+
+def set_response_cache(cache):
+    """
+    Installs a util.TTLCache for get_bot_info, get_chat_info, get_chat_membership and
+    get_chat_admins, None disables caching. Cached results are shared, do not modify them.
+    Writes through edit_bot_info, edit_chat_info, leave_chat, add_members and remove_member
+    invalidate the matching entries.
+    """
+    global response_cache
+    response_cache = cache
+
+
+def set_singleflight(group):
+    """
+    Installs a util.SingleFlight coalescing identical concurrent GET requests (same path,
+    query string and token) into one, None disables coalescing. Every caller gets the same
+    result object, do not modify it.
+    """
+    global singleflight
+    singleflight = group
+
+
+def set_metrics(collector):
+    """
+    Installs a util.Metrics observing every request attempt, None disables metrics.
+    The shared connection pool stats are registered with it as `connection_pool`.
+    """
+    global metrics
+    if collector is not None:
+        collector.register_stats('connection_pool', get_pool_stats)
+    metrics = collector
+
+
+def configure_retries(max_retries=None, backoff_factor=None, max_backoff=None):
+    if max_retries is not None:
+        retry_policy.max_retries = max_retries
+    if backoff_factor is not None:
+        retry_policy.backoff_factor = backoff_factor
+    if max_backoff is not None:
+        retry_policy.max_backoff = max_backoff
+
+
+def configure_circuit_breakers(failure_threshold=5, reset_timeout=30):
+    for endpoint in ENDPOINTS.values():
+        endpoint.breaker = util.CircuitBreaker(failure_threshold, reset_timeout)
 
 
-def _make_requests(token, make=None, verbs=None, method=None, chatId=None, params=None, files=None):
+def _make_requests(token, endpoint, files=None, **kwargs):
     '''
-    Makes a request to the TamTam API.
+    Makes a request to the TamTam API. Every apihandler function goes through here.
     token: The bot's API token. (Created with @PrimeBot)
-    make:
-        -basic: base_url = 'https://botapi.tamtam.chat/{0}?access_token={1}'
-        -chats: 'https://botapi.tamtam.chat/{0}/{1}?access_token={2}'
-            -chadId chats: identifier
-    HTTP verbs:
-        -delete: deleting resources
-        -get: getting resources, parameters are transmitted via URL
-        -patch: patching resources
-        -post: creation of resources (for example, sending new messages)
-        -put: editing resources
-    BOT method: Name of the API method to be called
-        me
-        chats 
-            -chatid [Requested chat identifie]
-        messages
-        answers
-        subscriptions
-        updates
-        upload
-    params: Optional parameters. Should be a dictionary with key-value pairs.
+    endpoint: The Endpoint to call, see ENDPOINTS.
     files: Optional files.
+    kwargs: Call arguments, mapped to the path, query string and body by `endpoint`.
     :return: The result parsed to a JSON dictionary.
     '''
-    read_timeout = READ_TIMEOUT
-    connect_timeout = CONNECT_TIMEOUT
+    cache = response_cache
+    if cache is not None:
+        if endpoint.cached:
+            key = (endpoint.name, token, kwargs.get('chat_id'))
+            found, result = cache.get(key)
+            if not found:
+                result = _dispatch(token, endpoint, files, kwargs)
+                cache.set(key, result)
+            return result
+        if endpoint.invalidates:
+            # Dropped before the write so no stale read can be served meanwhile, and after it
+            # so a read racing with the write is not kept either.
+            _invalidate(cache, token, endpoint, kwargs)
+            result = _dispatch(token, endpoint, files, kwargs)
+            if isinstance(result, futures.Future):
+                result.add_done_callback(lambda _: _invalidate(cache, token, endpoint, kwargs))
+            else:
+                _invalidate(cache, token, endpoint, kwargs)
+            return result
+    return _dispatch(token, endpoint, files, kwargs)
+
+
+def _invalidate(cache, token, endpoint, kwargs):
+    for name in endpoint.invalidates:
+        cache.invalidate((name, token, kwargs.get('chat_id')))
+
+
+def _dispatch(token, endpoint, files, kwargs):
+    request = endpoint.prepare(token, kwargs)
+    group = singleflight
+    if group is not None and endpoint.verbs == 'get' and not files:
+        key = (request['url'], tuple(sorted(request['params'].items())))
+        return group.do(key, _execute, endpoint, request)
+    limiter = rate_limiter
+    if endpoint.rate_limited and limiter is not None:
+        chat_id = kwargs.get('chat_id') or kwargs.get('user_id')
+        if limiter.mode == 'queue':
+            return limiter.submit(chat_id, _execute, endpoint, request, files, limiter, chat_id)
+        limiter.acquire(chat_id)
+        return _execute(endpoint, request, files, limiter, chat_id)
+    return _execute(endpoint, request, files)
+
+
+def _execute(endpoint, request, files=None, limiter=None, chat_id=None):
+    '''
+    Sends `request` through the endpoint's circuit breaker, retrying transient failures.
+    HTTP 429 is retried for every endpoint since the server did not process the call,
+    other transient errors only for idempotent endpoints. Uploads are never retried.
+    '''
+    breaker = endpoint.breaker
+    max_retries = 0 if files else retry_policy.max_retries
+    attempt = 0
+    while True:
+        collector = metrics
+        if not breaker.allow():
+            if attempt:
+                raise error
+            if collector is not None:
+                collector.observe(endpoint.name, None, 0.0, 'CircuitOpenException')
+            raise CircuitOpenException(endpoint.name)
+        started = time.perf_counter()
+        try:
+            result = _send_request(endpoint, request, files, limiter, chat_id)
+        except requests.exceptions.RequestException as e:
+            if collector is not None:
+                collector.observe(endpoint.name, None, time.perf_counter() - started, type(e).__name__)
+            breaker.record_failure()
+            if not endpoint.idempotent or attempt >= max_retries:
+                raise
+            error = e
+            delay = retry_policy.delay(attempt)
+        except ApiException as e:
+            if collector is not None:
+                collector.observe(endpoint.name, e.error_code, time.perf_counter() - started, type(e).__name__)
+            error = e
+            throttled = e.error_code == 429
+            if e.transient and not throttled:
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+            if not (throttled or e.transient and endpoint.idempotent) or attempt >= max_retries:
+                raise
+            delay = retry_policy.delay(attempt)
+            if throttled:
+                delay = max(delay, _retry_after(e.result))
+        except BaseException:
+            # Neither a success nor a server failure (e.g. an unserializable body): hand the trial back.
+            breaker.release()
+            raise
+        else:
+            if collector is not None:
+                collector.observe(endpoint.name, 200, time.perf_counter() - started)
+            breaker.record_success()
+            return result
+
+        logger.warning("{0} failed with {1}, retry {2} in {3:.2f}s".format(
+            endpoint.name, error, attempt + 1, delay))
+        time.sleep(delay)
+        attempt += 1
+        if limiter is not None:
+            limiter.acquire(chat_id)
+
+
+def _send_request(endpoint, request, files=None, limiter=None, chat_id=None):
     if files and format_header_param:
         fields.format_header_param = _no_encode(format_header_param)
-    if params:
-        if 'timeout' in params:
-            read_timeout = params['timeout'] + 10
-        if 'connect-timeout' in params:
-            connect_timeout = params['connect-timeout'] + 10
-
-    if make == 'basic':
-        base_url = 'https://botapi.tamtam.chat/{0}?access_token={1}'
-        request_url = base_url.format(method, token)
-        logger.debug("Request: method={0} url={1} params={2} files={3}".format(
-            method, request_url, params, files))
-        result = _get_req_session().request(verbs, request_url, params=params, files=files,
-                                            timeout=(connect_timeout, read_timeout), proxies=proxy)
-        logger.debug("The server returned: '{0}'".format(
-            result.text.encode('utf8')))
-        return _check_request(result, method)
-
-    elif make == 'chats':
-        base_url = 'https://botapi.tamtam.chat/{0}/{1}?access_token={2}'
-        request_url = base_url.format(method, chatId, token)
-        logger.debug("Request: method={0} url={1} params={2} files={3}".format(
-            method, request_url, params, files))
-        result = _get_req_session().request(verbs, request_url, params=params, files=files,
-                                            timeout=(connect_timeout, read_timeout), proxies=proxy)
+
+    data = None
+    headers = None
+    if request['body'] is not None:
+        data = util.json_dumps(request['body'])
+        headers = JSON_HEADERS
+
+    debug = logger.isEnabledFor(logging.DEBUG)
+    if debug:
+        logger.debug("Request: method={0} url={1} params={2} body={3} files={4}".format(
+            endpoint.name, request['url'], request['params'], request['body'], files))
+    timeout = (CONNECT_TIMEOUT, _read_timeout(endpoint, request['params']))
+    result = transport.request(endpoint.verbs, request['url'], params=request['params'], data=data,
+                               headers=headers, files=files, timeout=timeout)
+    if debug:
         logger.debug("The server returned: '{0}'".format(
             result.text.encode('utf8')))
-        return _check_request(result, method)
+    if result.status_code == 429 and limiter is not None:
+        limiter.backoff(_retry_after(result))
+    return _check_request(result, endpoint.name)
 
-    else:
-        raise TypeError(f"make '{make}' type Error!!!")
+
+def _retry_after(result, default=1.0):
+    try:
+        return float(result.headers.get('Retry-After', default))
+    except ValueError:
+        return default
 
 
 def _check_request(result, method):
@@ -105,7 +756,8 @@ def _check_request(result, method):
         raise ApiException(msg, method, result)
 
     try:
-        result_dict = result.json()
+        # Parse the raw bytes, skipping the charset detection and decoding behind `result.text`.
+        result_dict = util.json_loads(result.content)
     except:
         msg = 'The server returned an invalid JSON response. Response body:\n[{0}]' \
             .format(result.text.encode('utf8'))
@@ -139,6 +791,24 @@ class ApiException(Exception):
             "A request to the TamTam API was unsuccessful. {0}".format(msg))
         self.function_name = function_name
         self.result = result
+        self.error_code = getattr(result, 'status_code', None) or getattr(result, 'status', None)
+
+    @property
+    def transient(self):
+        '''
+        True when the same call may succeed later: HTTP 429 and 5xx responses.
+        '''
+        return self.error_code is not None and (self.error_code == 429 or self.error_code >= 500)
+
+
+class CircuitOpenException(ApiException):
+    """
+    Raised without calling the server while the circuit breaker of `function_name` is open.
+    """
+
+    def __init__(self, function_name):
+        super(CircuitOpenException, self).__init__(
+            'Circuit breaker for {0} is open.'.format(function_name), function_name, None)
 
 
 def get_bot_info(token):
@@ -163,22 +833,7 @@ def get_bot_info(token):
         description:(optional, sting <= 16000 characters, bot description)
         }
     '''
-    connect_timeout = CONNECT_TIMEOUT
-    read_timeout = READ_TIMEOUT
-    verbs = r'get'
-    method = r'me'
-    base_url = 'https://botapi.tamtam.chat/{0}?access_token={1}'
-    request_url = base_url.format(method, token)
-
-    payload = None
-
-    logger.debug("Request: method={0} url={1} params={2}".format(
-        method, request_url, payload))
-    result = _get_req_session().request(verbs, request_url, params=payload,
-                                        timeout=(connect_timeout, read_timeout), proxies=proxy)
-    logger.debug("The server returned: '{0}'".format(
-        result.text.encode('utf8')))
-    return _check_request(result, method)
+    return _make_requests(token, ENDPOINTS['get_bot_info'])
 
 
 def edit_bot_info(token, name=None, username=None, description=None, commands=None, photo=None):
@@ -220,32 +875,8 @@ def edit_bot_info(token, name=None, username=None, description=None, commands=No
         description:(optional, string <= 16000 characers, bot description)
     }
     '''
-    connect_timeout = CONNECT_TIMEOUT
-    read_timeout = READ_TIMEOUT
-    verbs = r'patch'
-    method = r'me'
-    base_url = 'https://botapi.tamtam.chat/{0}?access_token={1}'
-    request_url = base_url.format(method, token)
-
-    payload = {}
-    if name:
-        payload['name'] = name
-    if username:
-        payload['username'] = username
-    if description:
-        payload['description'] = description
-    if commands:
-        payload['commands'] = commands
-    if photo:
-        payload['photo'] = photo
-
-    logger.debug("Request: method={0} url={1} params={2}".format(
-        method, request_url, payload))
-    result = _get_req_session().request(verbs, request_url, params=payload,
-                                        timeout=(connect_timeout, read_timeout), proxies=proxy)
-    logger.debug("The server returned: '{0}'".format(
-        result.text.encode('utf8')))
-    return _check_request(result, method)
+    return _make_requests(token, ENDPOINTS['edit_bot_info'], name=name, username=username,
+                          description=description, commands=commands, photo=photo)
 
 
 def get_chats(token, count=None, marker=None):
@@ -287,26 +918,7 @@ def get_chats(token, count=None, marker=None):
         marker:(integer, Reference to the next page of requested chats)
     }
     '''
-    connect_timeout = CONNECT_TIMEOUT
-    read_timeout = READ_TIMEOUT
-    verbs = r'patch'
-    method = r'chats'
-    base_url = 'https://botapi.tamtam.chat/{0}?access_token={1}'
-    request_url = base_url.format(method, token)
-
-    payload = {}
-    if count:
-        payload['count'] = count
-    if marker:
-        payload['marker'] = marker
-
-    logger.debug("Request: method={0} url={1} params={2}".format(
-        method, request_url, payload))
-    result = _get_req_session().request(verbs, request_url, params=payload,
-                                        timeout=(connect_timeout, read_timeout), proxies=proxy)
-    logger.debug("The server returned: '{0}'".format(
-        result.text.encode('utf8')))
-    return _check_request(result, method)
+    return _make_requests(token, ENDPOINTS['get_chats'], count=count, marker=marker)
 
 
 def get_chat_info(token, chat_id):
@@ -343,22 +955,7 @@ def get_chat_info(token, chat_id):
 
     }
     '''
-    connect_timeout = CONNECT_TIMEOUT
-    read_timeout = READ_TIMEOUT
-    verbs = r'get'
-    method = r'chats'
-    base_url = 'https://botapi.tamtam.chat/{0}/{1}?access_token={2}'
-    request_url = base_url.format(method, chat_id, token)
-
-    payload = None
-
-    logger.debug("Request: method={0} url={1} params={2}".format(
-        method, request_url, payload))
-    result = _get_req_session().request(verbs, request_url, params=payload,
-                                        timeout=(connect_timeout, read_timeout), proxies=proxy)
-    logger.debug("The server returned: '{0}'".format(
-        result.text.encode('utf8')))
-    return _check_request(result, method)
+    return _make_requests(token, ENDPOINTS['get_chat_info'], chat_id=chat_id)
 
 
 def edit_chat_info(token, chat_id, icon, title):
@@ -405,26 +1002,7 @@ def edit_chat_info(token, chat_id, icon, title):
 
     }
     '''
-    connect_timeout = CONNECT_TIMEOUT
-    read_timeout = READ_TIMEOUT
-    verbs = r'patch'
-    method = r'chats'
-    base_url = 'https://botapi.tamtam.chat/{0}/{1}?access_token={2}'
-    request_url = base_url.format(method, chat_id, token)
-
-    payload = {}
-    if icon:
-        payload['icon'] = icon
-    if title:
-        payload['title'] = title
-
-    logger.debug("Request: method={0} url={1} params={2}".format(
-        method, request_url, payload))
-    result = _get_req_session().request(verbs, request_url, params=payload,
-                                        timeout=(connect_timeout, read_timeout), proxies=proxy)
-    logger.debug("The server returned: '{0}'".format(
-        result.text.encode('utf8')))
-    return _check_request(result, method)
+    return _make_requests(token, ENDPOINTS['edit_chat_info'], chat_id=chat_id, icon=icon, title=title)
 
 
 def send_chat_action(token, chat_id, action):
@@ -446,22 +1024,7 @@ def send_chat_action(token, chat_id, action):
         message:(optional, string, explanatory message if the result is not succesful)
     }
     '''
-    connect_timeout = CONNECT_TIMEOUT
-    read_timeout = READ_TIMEOUT
-    verbs = r'post'
-    method = r'chats'
-    base_url = 'https://botapi.tamtam.chat/{0}/{1}/action?access_token={2}'
-    request_url = base_url.format(method, chat_id, token)
-
-    payload = {'action': str(action)}
-
-    logger.debug("Request: method={0} url={1} params={2}".format(
-        method, request_url, payload))
-    result = _get_req_session().request(verbs, request_url, params=payload,
-                                        timeout=(connect_timeout, read_timeout), proxies=proxy)
-    logger.debug("The server returned: '{0}'".format(
-        result.text.encode('utf8')))
-    return _check_request(result, method)
+    return _make_requests(token, ENDPOINTS['send_chat_action'], chat_id=chat_id, action=str(action))
 
 
 def get_chat_membership(token, chat_id):
@@ -487,22 +1050,7 @@ def get_chat_membership(token, chat_id):
         permissions:(array of string, items Enum: 'read_all_messages', 'add_remove_members', 'add_admins', 'change_chat_info', 'pin_message', 'write'. permissions in chat if member is admin. null otherwise)
     }    
     '''
-    connect_timeout = CONNECT_TIMEOUT
-    read_timeout = READ_TIMEOUT
-    verbs = r'get'
-    method = r'chats'
-    base_url = 'https://botapi.tamtam.chat/{0}/{1}/members/me?access_token={2}'
-    request_url = base_url.format(method, chat_id, token)
-
-    payload = None
-
-    logger.debug("Request: method={0} url={1} params={2}".format(
-        method, request_url, payload))
-    result = _get_req_session().request(verbs, request_url, timeout=(
-        connect_timeout, read_timeout), parmas=payload, proxies=proxy)
-    logger.debug("The server returned: '{0}'".format(
-        result.text.encode('utf8')))
-    return _check_request(result, method)
+    return _make_requests(token, ENDPOINTS['get_chat_membership'], chat_id=chat_id)
 
 
 def leave_chat(token, chat_id):
@@ -520,22 +1068,7 @@ def leave_chat(token, chat_id):
         message:(optional, string, explanatory message if the result is not successful)
     }    
     '''
-    connect_timeout = CONNECT_TIMEOUT
-    read_timeout = READ_TIMEOUT
-    verbs = r'delete'
-    method = r'chats'
-    base_url = 'https://botapi.tamtam.chat/{0}/{1}/members/me?access_token={2}'
-    request_url = base_url.format(method, chat_id, token)
-
-    payload = None
-
-    logger.debug("Request: method={0} url={1} params={2}".format(
-        method, request_url, payload))
-    result = _get_req_session().request(verbs, request_url, timeout=(
-        connect_timeout, read_timeout), params=payload, proxies=proxy)
-    logger.debug("The server returned: '{0}'".format(
-        result.text.encode('utf8')))
-    return _check_request(result, method)
+    return _make_requests(token, ENDPOINTS['leave_chat'], chat_id=chat_id)
 
 
 def get_chat_admins(token, chat_id):
@@ -566,22 +1099,7 @@ def get_chat_admins(token, chat_id):
         marker:(optional, integer, Pointer to the next data page)
     }    
     '''
-    connect_timeout = CONNECT_TIMEOUT
-    read_timeout = READ_TIMEOUT
-    verbs = r'get'
-    method = r'chats'
-    base_url = 'https://botapi.tamtam.chat/{0}/{1}/members/admins?access_token={2}'
-    request_url = base_url.format(method, chat_id, token)
-
-    payload = None
-
-    logger.debug("Request: method={0} url={1} params={2}".format(
-        method, request_url, payload))
-    result = _get_req_session().request(verbs, request_url, timeout=(
-        connect_timeout, read_timeout), params=payload, proxies=proxy)
-    logger.debug("The server returned: '{0}'".format(
-        result.text.encode('utf8')))
-    return _check_request(result, method)
+    return _make_requests(token, ENDPOINTS['get_chat_admins'], chat_id=chat_id)
 
 
 def get_members(token, chat_id, user_ids=None, marker=None, count=None):
@@ -618,28 +1136,8 @@ def get_members(token, chat_id, user_ids=None, marker=None, count=None):
         marker:(optional, integer, Pointer to the next data page)
     }    
     '''
-    connect_timeout = CONNECT_TIMEOUT
-    read_timeout = READ_TIMEOUT
-    verbs = r'get'
-    method = r'chats'
-    base_url = 'https://botapi.tamtam.chat/{0}/{1}/members?access_token={2}'
-    request_url = base_url.format(method, chat_id, token)
-
-    payload = {}
-    if user_ids:
-        payload['user_ids'] = user_ids
-    if marker:
-        payload['marker'] = marker
-    if count:
-        payload['count'] = count
-
-    logger.debug("Request: method={0} url={1} params={2}".format(
-        method, request_url, payload))
-    result = _get_req_session().request(verbs, request_url, params=payload,
-                                        timeout=(connect_timeout, read_timeout), proxies=proxy)
-    logger.debug("The server returned: '{0}'".format(
-        result.text.encode('utf8')))
-    return _check_request(result, method)
+    return _make_requests(token, ENDPOINTS['get_members'], chat_id=chat_id, user_ids=user_ids,
+                          marker=marker, count=count)
 
 
 def add_members(token, chat_id, user_ids):
@@ -661,22 +1159,7 @@ def add_members(token, chat_id, user_ids):
         message:(optional, string, Explanatory message if the result is not successful)
     }    
     '''
-    connect_timeout = CONNECT_TIMEOUT
-    read_timeout = READ_TIMEOUT
-    verbs = r'post'
-    method = r'chats'
-    base_url = 'https://botapi.tamtam.chat/{0}/{1}/members?access_token={2}'
-    request_url = base_url.format(method, chat_id, token)
-
-    payload = {'user_ids': user_ids}
-
-    logger.debug("Request: method={0} url={1} params={2}".format(
-        method, request_url, payload))
-    result = _get_req_session().request(verbs, request_url, params=payload,
-                                        timeout=(connect_timeout, read_timeout), proxies=proxy)
-    logger.debug("The server returned: '{0}'".format(
-        result.text.encode('utf8')))
-    return _check_request(result, method)
+    return _make_requests(token, ENDPOINTS['add_members'], chat_id=chat_id, user_ids=user_ids)
 
 
 def remove_member(token, chat_id, user_id):
@@ -698,22 +1181,7 @@ def remove_member(token, chat_id, user_id):
         message:(optional, string, Explanatory message if the result is not successful)
     }    
     '''
-    connect_timeout = CONNECT_TIMEOUT
-    read_timeout = READ_TIMEOUT
-    verbs = r'delete'
-    method = r'chats'
-    base_url = 'https://botapi.tamtam.chat/{0}/{1}/members?access_token={2}'
-    request_url = base_url.format(method, chat_id, token)
-
-    payload = {'user_id': user_id}
-
-    logger.debug("Request: method={0} url={1} params={2}".format(
-        method, request_url, payload))
-    result = _get_req_session().request(verbs, request_url, params=payload,
-                                        timeout=(connect_timeout, read_timeout), proxies=proxy)
-    logger.debug("The server returned: '{0}'".format(
-        result.text.encode('utf8')))
-    return _check_request(result, method)
+    return _make_requests(token, ENDPOINTS['remove_member'], chat_id=chat_id, user_id=user_id)
 
 
 def get_messages(token, chat_id=None, message_ids=None, chat_from=None, to=None, count=None):
@@ -762,32 +1230,8 @@ def get_messages(token, chat_id=None, message_ids=None, chat_from=None, to=None,
                 url:(optional, string, message public url, can be null for dialogs or non-public chats/channel)]
     } 
     '''
-    connect_timeout = CONNECT_TIMEOUT
-    read_timeout = READ_TIMEOUT
-    verbs = r'get'
-    method = r'messages'
-    base_url = 'https://botapi.tamtam.chat/{0}?access_token={1}'
-    request_url = base_url.format(method, token)
-
-    payload = {}
-    if chat_id:
-        payload['chatId'] = chat_id
-    if message_ids:
-        payload['message_ids'] = message_ids
-    if chat_from:
-        payload['from'] = chat_from
-    if to:
-        payload['to'] = to
-    if count:
-        payload['count'] = count
-
-    logger.debug("Request: method={0} url={1} params={2}".format(
-        method, request_url, payload))
-    result = _get_req_session().request(verbs, request_url, params=payload,
-                                        timeout=(connect_timeout, read_timeout), proxies=proxy)
-    logger.debug("The server returned: '{0}'".format(
-        result.text.encode('utf8')))
-    return _check_request(result, method)
+    return _make_requests(token, ENDPOINTS['get_messages'], chat_id=chat_id, message_ids=message_ids,
+                          chat_from=chat_from, to=to, count=count)
 
 
 def send_message(token, chat_id=None, user_id=None, text=None, attachments=None, link=None, notify=None):
@@ -813,31 +1257,285 @@ def send_message(token, chat_id=None, user_id=None, text=None, attachments=None,
         message:(object message, message in chat)
     }
     '''
-    connect_timeout = CONNECT_TIMEOUT
-    read_timeout = READ_TIMEOUT
-    verbs = r'post'
-    method = r'messages'
-    base_url = 'https://botapi.tamtam.chat/{0}?access_token={1}'
-    request_url = base_url.format(method, token)
-
-    payload = {}
-    if chat_id:
-        payload['chatId'] = chat_id
-    if user_id:
-        payload['user_id'] = user_id
-    if text:
-        payload['text'] = text
-    if attachments:
-        payload['attachments'] = attachments
-    if link:
-        payload['link'] = link
-    if notify:
-        payload['notify'] = notify
-
-    logger.debug("Request: method={0} url={1} params={2}".format(
-        method, request_url, payload))
-    result = _get_req_session().request(verbs, request_url, params=payload,
-                                        timeout=(connect_timeout, read_timeout), proxies=proxy)
-    logger.debug("The server returned: '{0}'".format(
-        result.text.encode('utf8')))
-    return _check_request(result, method)    
\ No newline at end of file
+    return _make_requests(token, ENDPOINTS['send_message'], chat_id=chat_id, user_id=user_id, text=text,
+                          attachments=attachments, link=link, notify=notify)
+
+
+def get_upload_url(token, upload_type):
+    '''Get upload URL
+    HTTP_verbs='post'
+    request_url='https://botapi.tamtam.chat/uploads?access_token={}'
+    Returns the URL for the subsequent file upload.
+    QUERY PARAMETERS:
+    {
+        type:(any, Enum: 'image', 'video', 'audio', 'file', uploaded file type)
+    }
+    RESPONSE: application/json
+    {
+        url:(string, URL to upload)
+        token:(optional, string, video or audio token for send message)
+    }
+    '''
+    return _make_requests(token, ENDPOINTS['get_upload_url'], upload_type=upload_type)
+
+
+def upload_file(token, path, upload_type='file', chunk_size=UPLOAD_CHUNK_SIZE):
+    '''Upload file
+    Gets an upload URL and streams the file at `path` to it as multipart/form-data,
+    memory-mapped and sent in `chunk_size` pieces instead of being read into memory.
+    upload_type: 'image', 'video', 'audio' or 'file'
+    :return: the attachment payload to send, e.g. {'type': upload_type, 'payload': upload_file(...)}
+    '''
+    info = get_upload_url(token, upload_type)
+    body = _MultipartFile(path, chunk_size)
+    logger.debug("Upload: url={0} path={1} size={2}".format(info['url'], path, len(body)))
+    result = transport.request('post', info['url'], data=body, headers={'Content-Type': body.content_type},
+                               timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+    if upload_type in ('video', 'audio') and info.get('token'):
+        # The token comes with the upload URL, the upload response carries nothing to keep.
+        if result.status_code != 200:
+            _check_request(result, 'upload_file')
+        return {'token': info['token']}
+    return _check_request(result, 'upload_file')
+
+
+class _MultipartFile:
+    """
+    Streaming multipart/form-data body holding one file in the 'data' field.
+    Has a length, so requests sends it with Content-Length rather than chunked.
+    """
+
+    def __init__(self, path, chunk_size):
+        self.path = path
+        self.chunk_size = chunk_size
+        boundary = uuid4().hex
+        self.content_type = 'multipart/form-data; boundary={0}'.format(boundary)
+        filename = os.path.basename(path).replace('"', '%22')
+        self.head = ('--{0}\r\nContent-Disposition: form-data; name="data"; filename="{1}"\r\n'
+                     'Content-Type: application/octet-stream\r\n\r\n').format(boundary, filename).encode('utf-8')
+        self.tail = '\r\n--{0}--\r\n'.format(boundary).encode('utf-8')
+        self.size = os.path.getsize(path)
+
+    def __len__(self):
+        return len(self.head) + self.size + len(self.tail)
+
+    def __iter__(self):
+        yield self.head
+        with open(self.path, 'rb') as file:
+            if self.size:
+                with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    for offset in range(0, self.size, self.chunk_size):
+                        yield mapped[offset:offset + self.chunk_size]
+        yield self.tail
+
+
+def get_updates(token, limit=None, timeout=None, marker=None, update_types=None):
+    '''Get updates
+    HTTP_verbs='get'
+    request_url='https://botapi.tamtam.chat/updates?access_token={}'
+    You can use this method for getting updates in case your bot is not subscribed to WebHook.
+    The method is based on long polling. Every update has its own sequence number.
+    `marker` property in response points to the next upcoming update.
+    All previous updates are considered as committed after passing `marker` parameter.
+    If `marker` parameter is not passed, your bot will get all updates happened after the last commitment.
+    QUERY PARAMETERS:
+    {
+        limit:(optional, integer [1..1000], default 100, maximum amount of updates to be received)
+        timeout:(optional, integer [0..90], default 30, timeout in seconds for long polling)
+        marker:(optional, integer, pass `null` to get updates you didn't get yet)
+        types:(optional, array of string, comma separated list of update types your bot want to receive)
+    }
+    RESPONSE: application/json
+    {
+        updates:(array of object, page of updates)
+        marker:(integer, pointer to the next data page)
+    }
+    '''
+    return _make_requests(token, ENDPOINTS['get_updates'], limit=limit, timeout=timeout, marker=marker,
+                          update_types=update_types)
+
+
+def get_subscriptions(token):
+    '''Get subscriptions
+    HTTP_verbs='get'
+    request_url='https://botapi.tamtam.chat/subscriptions?access_token={}'
+    In case your bot gets data via WebHook, the method returns list of all subscriptions
+    RESPONSE: application/json
+    {
+        subscriptions:(array of object, list of current subscriptions
+            Array [
+                url:(string, webhook URL)
+                time:(integer, unix-time when subscription was created)
+                update_types:(optional, array of string, update types bot subscribed for)
+                version:(optional, string)
+            ])
+    }
+    '''
+    return _make_requests(token, ENDPOINTS['get_subscriptions'])
+
+
+def subscribe(token, url, update_types=None, version=None):
+    '''Subscribe
+    HTTP_verbs='post'
+    request_url='https://botapi.tamtam.chat/subscriptions?access_token={}'
+    Subscribes bot to receive updates via WebHook. After calling this method, the bot will receive
+    notifications about new events in chat rooms at the specified URL.
+    Your server must be listening on one of the following ports: 80, 8080, 443, 8443, 16384-32383
+    REQUEST BODY SCHEMA: application/json
+    {
+        url:(string, URL of HTTP(S)-endpoint of your bot. Must starts with http(s)://)
+        update_types:(optional, array of string, list of update types your bot want to receive)
+        version:(optional, string, version of API)
+    }
+    RESPONSE: application/json
+    {
+        success:(boolean, true if request was successful. false otherwise)
+        message:(optional, string, explanatory message if the result is not successful)
+    }
+    '''
+    return _make_requests(token, ENDPOINTS['subscribe'], url=url, update_types=update_types, version=version)
+
+
+def unsubscribe(token, url):
+    '''Unsubscribe
+    HTTP_verbs='delete'
+    request_url='https://botapi.tamtam.chat/subscriptions?access_token={}'
+    Unsubscribes bot from receiving updates via WebHook. After calling the method, the bot stops
+    receiving notifications about new events. Notification via the long-poll API becomes available for the bot
+    QUERY PARAMETERS:
+    {
+        url:(string, URL to remove from WebHook subscriptions)
+    }
+    RESPONSE: application/json
+    {
+        success:(boolean, true if request was successful. false otherwise)
+        message:(optional, string, explanatory message if the result is not successful)
+    }
+    '''
+    return _make_requests(token, ENDPOINTS['unsubscribe'], url=url)
+
+
+def send_long_message(token, text, chat_id=None, user_id=None, window=1, **kwargs):
+    '''send long message
+    Sends `text` of any length as consecutive messages of at most 4000 characters, split on
+    line and word boundaries by util.smart_split. Chunks are produced while earlier ones are being sent.
+    window: number of send_message calls in flight. 1 keeps delivery strictly in order, a larger
+        window sends faster but the server may receive overlapping chunks out of order.
+    kwargs: other send_message arguments (attachments, link, notify), applied to every chunk.
+    :return: the list of send_message results, in chunk order.
+    '''
+    results = []
+    if window <= 1:
+        for chunk in util.smart_split(text):
+            results.append(_result(send_message(token, chat_id=chat_id, user_id=user_id, text=chunk, **kwargs)))
+        return results
+
+    in_flight = collections.deque()
+    with futures.ThreadPoolExecutor(window) as executor:
+        for chunk in util.smart_split(text):
+            if len(in_flight) >= window:
+                results.append(_result(in_flight.popleft().result()))
+            in_flight.append(executor.submit(send_message, token, chat_id=chat_id, user_id=user_id,
+                                             text=chunk, **kwargs))
+        while in_flight:
+            results.append(_result(in_flight.popleft().result()))
+    return results
+
+
+def _result(result):
+    # Rate limiting in 'queue' mode turns results into futures.
+    return result.result() if isinstance(result, futures.Future) else result
+
+
+def _iter_pages(pages, key, prefetch, factory=None):
+    for page in util.prefetch(pages, prefetch):
+        for item in page.get(key) or ():
+            yield item if factory is None else factory(item)
+
+
+def iter_chats(token, count=None, prefetch=1, typed=False):
+    '''Iterate over all chats
+    Lazily walks every page of get_chats, requesting the next page in the background
+    while the current one is consumed.
+    prefetch: number of pages fetched ahead
+    typed: yield types.Chat objects instead of dicts
+    :return: a generator of chat objects.
+    '''
+    def pages():
+        marker = None
+        while True:
+            page = get_chats(token, count=count, marker=marker)
+            yield page
+            marker = page.get('marker')
+            if not marker:
+                return
+
+    return _iter_pages(pages(), 'chats', prefetch, types.Chat if typed else None)
+
+
+def iter_members(token, chat_id, count=None, prefetch=1, typed=False):
+    '''Iterate over all members
+    Lazily walks every page of get_members, requesting the next page in the background
+    while the current one is consumed.
+    prefetch: number of pages fetched ahead
+    typed: yield types.User objects instead of dicts
+    :return: a generator of member objects.
+    '''
+    def pages():
+        marker = None
+        while True:
+            page = get_members(token, chat_id, marker=marker, count=count)
+            yield page
+            marker = page.get('marker')
+            if not marker:
+                return
+
+    return _iter_pages(pages(), 'members', prefetch, types.User if typed else None)
+
+
+def iter_messages(token, chat_id, chat_from=None, to=None, count=None, prefetch=1, typed=False):
+    '''Iterate over messages
+    Lazily walks get_messages from the newest message (or `chat_from`) back to `to`,
+    requesting the next page in the background while the current one is consumed.
+    Each next page starts at the timestamp of the oldest message received, skipping the messages
+    of that timestamp already yielded, so messages sharing it across pages are not lost.
+    prefetch: number of pages fetched ahead
+    typed: yield types.Message objects instead of dicts
+    :return: a generator of message objects.
+    '''
+    def pages():
+        start = chat_from
+        seen = set()
+        page_count = count
+        while True:
+            page = get_messages(token, chat_id=chat_id, chat_from=start, to=to, count=page_count)
+            messages = page.get('messages')
+            if not messages:
+                yield page
+                return
+            fresh = [message for message in messages if _message_id(message) not in seen]
+            if fresh:
+                yield page if len(fresh) == len(messages) else dict(page, messages=fresh)
+            last = messages[-1]['timestamp']
+            if not fresh:
+                requested = page_count or MESSAGES_PAGE_DEFAULT
+                if len(messages) >= requested and requested < MESSAGES_PAGE_LIMIT:
+                    # More messages share this timestamp than a page holds, ask for a larger page.
+                    page_count = min(len(seen) + (count or MESSAGES_PAGE_DEFAULT), MESSAGES_PAGE_LIMIT)
+                    continue
+                # Everything at this timestamp has been yielded (or cannot be reached), step past it.
+                last -= 1
+                seen = set()
+            elif last != start:
+                seen = set()
+            page_count = count
+            seen.update(_message_id(message) for message in messages if message['timestamp'] == last)
+            start = last
+            if to is not None and start < to:
+                return
+
+    return _iter_pages(pages(), 'messages', prefetch, types.Message if typed else None)
+
+
+def _message_id(message):
+    return (message.get('body') or {}).get('mid')
@@ -0,0 +1,239 @@
+import asyncio
+import logging
+import time
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+import tambotapi
+from tambotapi import apihandler, util
+from tambotapi.apihandler import ApiException, ENDPOINTS, CONNECT_TIMEOUT, JSON_HEADERS, _read_timeout
+
+# Connections kept open by the shared connector, and requests allowed in flight at once.
+MAX_CONNECTIONS = 100
+CONCURRENCY_LIMIT = 1000
+
+logger = tambotapi.logger
+proxy = None
+
+
+class SessionManager:
+    """
+    Holds one pooled aiohttp session and the semaphore bounding concurrent requests.
+    Both are created lazily inside the running event loop, and again when a different loop
+    runs (e.g. a later asyncio.run), since they cannot be used outside the loop they belong to.
+    """
+
+    def __init__(self):
+        self.session = None
+        self.semaphore = None
+        self.loop = None
+        self.concurrency_limit = CONCURRENCY_LIMIT
+
+    async def get(self):
+        if aiohttp is None:
+            raise ImportError('aiohttp is required for asyncio_apihandler, install tambotapi[aiohttp]')
+        # The running loop, asyncio.get_running_loop needs Python 3.7.
+        loop = asyncio.get_event_loop()
+        if loop is not self.loop:
+            if self.session is not None and not self.session.closed:
+                if self.loop.is_closed():
+                    # Nothing is left to wait for, the connections died with their loop.
+                    await self.session.close()
+                else:
+                    asyncio.run_coroutine_threadsafe(self.session.close(), self.loop)
+            self.session = None
+            self.semaphore = None
+            self.loop = loop
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=MAX_CONNECTIONS)
+            self.session = aiohttp.ClientSession(connector=connector)
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.concurrency_limit)
+        return self.session, self.semaphore
+
+    def set_concurrency_limit(self, limit):
+        self.concurrency_limit = limit
+        self.semaphore = None
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+        self.semaphore = None
+        self.loop = None
+
+
+session_manager = SessionManager()
+
+
+def set_concurrency_limit(limit):
+    session_manager.set_concurrency_limit(limit)
+
+
+async def close_session():
+    await session_manager.close()
+
+
+async def _make_requests(token, endpoint, **kwargs):
+    '''
+    Makes a request to the TamTam API, see apihandler._make_requests.
+    token: The bot's API token.
+    endpoint: The apihandler.Endpoint to call, see apihandler.ENDPOINTS.
+    kwargs: Call arguments, mapped to the path, query string and body by `endpoint`.
+    :return: The result parsed to a JSON dictionary.
+    '''
+    request = endpoint.prepare(token, kwargs)
+    debug = logger.isEnabledFor(logging.DEBUG)
+    if debug:
+        logger.debug("Request: method={0} url={1} params={2} body={3}".format(
+            endpoint.name, request['url'], request['params'], request['body']))
+
+    session, semaphore = await session_manager.get()
+    timeout = aiohttp.ClientTimeout(sock_connect=CONNECT_TIMEOUT, sock_read=_read_timeout(endpoint, request['params']))
+    data = None
+    headers = None
+    if request['body'] is not None:
+        data = util.json_dumps(request['body'])
+        headers = JSON_HEADERS
+    collector = apihandler.metrics
+    async with semaphore:
+        started = time.perf_counter()
+        try:
+            async with session.request(endpoint.verbs, request['url'], params=request['params'],
+                                       data=data, headers=headers, timeout=timeout, proxy=proxy) as result:
+                content = await result.read()
+                if debug:
+                    logger.debug("The server returned: '{0}'".format(content))
+                result_dict = _check_request(result, content, endpoint.name)
+        except ApiException as e:
+            if collector is not None:
+                collector.observe(endpoint.name, e.error_code, time.perf_counter() - started, type(e).__name__)
+            raise
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if collector is not None:
+                collector.observe(endpoint.name, None, time.perf_counter() - started, type(e).__name__)
+            raise
+        if collector is not None:
+            collector.observe(endpoint.name, 200, time.perf_counter() - started)
+        return result_dict
+
+
+def _check_request(result, content, method):
+    '''
+    Checks whether `result` is a valid API response, see apihandler._check_request.
+    '''
+    if result.status != 200:
+        msg = 'The server returned HTTP {0} {1}. Response body:\n[{2}]' \
+            .format(result.status, result.reason, content)
+        raise ApiException(msg, method, result)
+
+    try:
+        result_dict = util.json_loads(content)
+    except ValueError:
+        msg = 'The server returned an invalid JSON response. Response body:\n[{0}]' \
+            .format(content)
+        raise ApiException(msg, method, result)
+    return result_dict
+
+
+async def get_bot_info(token):
+    '''Get current bot info, see apihandler.get_bot_info'''
+    return await _make_requests(token, ENDPOINTS['get_bot_info'])
+
+
+async def edit_bot_info(token, name=None, username=None, description=None, commands=None, photo=None):
+    '''Edit current bot info, see apihandler.edit_bot_info'''
+    return await _make_requests(token, ENDPOINTS['edit_bot_info'], name=name, username=username,
+                                description=description, commands=commands, photo=photo)
+
+
+async def get_chats(token, count=None, marker=None):
+    '''Get all chats, see apihandler.get_chats'''
+    return await _make_requests(token, ENDPOINTS['get_chats'], count=count, marker=marker)
+
+
+async def get_chat_info(token, chat_id):
+    '''Get chat, see apihandler.get_chat_info'''
+    return await _make_requests(token, ENDPOINTS['get_chat_info'], chat_id=chat_id)
+
+
+async def edit_chat_info(token, chat_id, icon, title):
+    '''Edit chat info, see apihandler.edit_chat_info'''
+    return await _make_requests(token, ENDPOINTS['edit_chat_info'], chat_id=chat_id, icon=icon, title=title)
+
+
+async def send_chat_action(token, chat_id, action):
+    '''Send action, see apihandler.send_chat_action'''
+    return await _make_requests(token, ENDPOINTS['send_chat_action'], chat_id=chat_id, action=str(action))
+
+
+async def get_chat_membership(token, chat_id):
+    '''Get chat membership, see apihandler.get_chat_membership'''
+    return await _make_requests(token, ENDPOINTS['get_chat_membership'], chat_id=chat_id)
+
+
+async def leave_chat(token, chat_id):
+    '''Leave chat, see apihandler.leave_chat'''
+    return await _make_requests(token, ENDPOINTS['leave_chat'], chat_id=chat_id)
+
+
+async def get_chat_admins(token, chat_id):
+    '''Get chat admins, see apihandler.get_chat_admins'''
+    return await _make_requests(token, ENDPOINTS['get_chat_admins'], chat_id=chat_id)
+
+
+async def get_members(token, chat_id, user_ids=None, marker=None, count=None):
+    '''Get members, see apihandler.get_members'''
+    return await _make_requests(token, ENDPOINTS['get_members'], chat_id=chat_id, user_ids=user_ids,
+                                marker=marker, count=count)
+
+
+async def add_members(token, chat_id, user_ids):
+    '''Add members, see apihandler.add_members'''
+    return await _make_requests(token, ENDPOINTS['add_members'], chat_id=chat_id, user_ids=user_ids)
+
+
+async def remove_member(token, chat_id, user_id):
+    '''Remove member, see apihandler.remove_member'''
+    return await _make_requests(token, ENDPOINTS['remove_member'], chat_id=chat_id, user_id=user_id)
+
+
+async def get_messages(token, chat_id=None, message_ids=None, chat_from=None, to=None, count=None):
+    '''Get messages, see apihandler.get_messages'''
+    return await _make_requests(token, ENDPOINTS['get_messages'], chat_id=chat_id, message_ids=message_ids,
+                                chat_from=chat_from, to=to, count=count)
+
+
+async def send_message(token, chat_id=None, user_id=None, text=None, attachments=None, link=None, notify=None):
+    '''Send message, see apihandler.send_message'''
+    return await _make_requests(token, ENDPOINTS['send_message'], chat_id=chat_id, user_id=user_id, text=text,
+                                attachments=attachments, link=link, notify=notify)
+
+
+async def get_updates(token, limit=None, timeout=None, marker=None, update_types=None):
+    '''Get updates, see apihandler.get_updates'''
+    return await _make_requests(token, ENDPOINTS['get_updates'], limit=limit, timeout=timeout, marker=marker,
+                                update_types=update_types)
+
+
+async def get_subscriptions(token):
+    '''Get subscriptions, see apihandler.get_subscriptions'''
+    return await _make_requests(token, ENDPOINTS['get_subscriptions'])
+
+
+async def subscribe(token, url, update_types=None, version=None):
+    '''Subscribe, see apihandler.subscribe'''
+    return await _make_requests(token, ENDPOINTS['subscribe'], url=url, update_types=update_types, version=version)
+
+
+async def unsubscribe(token, url):
+    '''Unsubscribe, see apihandler.unsubscribe'''
+    return await _make_requests(token, ENDPOINTS['unsubscribe'], url=url)
+
+
+async def get_upload_url(token, upload_type):
+    '''Get upload URL, see apihandler.get_upload_url'''
+    return await _make_requests(token, ENDPOINTS['get_upload_url'], upload_type=upload_type)
@@ -0,0 +1,318 @@
+"""
+Typed views over TamTam API objects.
+
+Every object keeps a reference to the parsed JSON dict it wraps (`json`) and has no
+__dict__. Plain fields are read from that dict on access; nested objects are built
+the first time they are accessed and kept in a slot. Fields without a declared
+accessor are still reachable as attributes, e.g. `chat.participants_count`.
+"""
+
+
+class _Nested:
+    """
+    Descriptor building `factory(json[key])` on first access and caching it in `slot`.
+    """
+
+    def __init__(self, key, factory, slot):
+        self.key = key
+        self.factory = factory
+        self.slot = slot
+
+    def __get__(self, obj, owner):
+        if obj is None:
+            return self
+        try:
+            return getattr(obj, self.slot)
+        except AttributeError:
+            value = self.factory(obj.json.get(self.key))
+            setattr(obj, self.slot, value)
+            return value
+
+
+def _list_of(factory):
+    def build(items):
+        return [factory(item) for item in items] if items else []
+
+    return build
+
+
+class JsonObject:
+    __slots__ = ('json',)
+
+    def __init__(self, json):
+        self.json = json
+
+    @classmethod
+    def de_json(cls, json):
+        return None if json is None else cls(json)
+
+    def __reduce__(self):
+        return type(self), (self.json,)
+
+    def __getattr__(self, name):
+        # Private names are slots (or copy/pickle protocol lookups), never JSON fields.
+        if name.startswith('_'):
+            raise AttributeError("{0!r} object has no attribute {1!r}".format(type(self).__name__, name))
+        try:
+            return self.json[name]
+        except KeyError:
+            raise AttributeError("{0!r} object has no attribute {1!r}".format(type(self).__name__, name))
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.json == other.json
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def to_dict(self):
+        return self.json
+
+    def __repr__(self):
+        return '{0}({1!r})'.format(type(self).__name__, self.json)
+
+
+class User(JsonObject):
+    __slots__ = ()
+
+    @property
+    def user_id(self):
+        return self.json.get('user_id')
+
+    @property
+    def name(self):
+        return self.json.get('name')
+
+    @property
+    def username(self):
+        return self.json.get('username')
+
+
+class Recipient(JsonObject):
+    __slots__ = ()
+
+    @property
+    def chat_id(self):
+        return self.json.get('chat_id')
+
+    @property
+    def chat_type(self):
+        return self.json.get('chat_type')
+
+    @property
+    def user_id(self):
+        return self.json.get('user_id')
+
+
+class Attachment(JsonObject):
+    """
+    Base of all attachments, Attachment.de_json returns the subclass matching `type`.
+    """
+    __slots__ = ()
+    TYPES = {}
+
+    @classmethod
+    def de_json(cls, json):
+        if json is None:
+            return None
+        return Attachment.TYPES.get(json.get('type'), Attachment)(json)
+
+    @property
+    def type(self):
+        return self.json.get('type')
+
+    @property
+    def payload(self):
+        return self.json.get('payload')
+
+
+class MediaAttachment(Attachment):
+    __slots__ = ()
+
+    @property
+    def url(self):
+        return (self.json.get('payload') or {}).get('url')
+
+    @property
+    def token(self):
+        return (self.json.get('payload') or {}).get('token')
+
+
+class ImageAttachment(MediaAttachment):
+    __slots__ = ()
+
+
+class VideoAttachment(MediaAttachment):
+    __slots__ = ()
+
+
+class AudioAttachment(MediaAttachment):
+    __slots__ = ()
+
+
+class FileAttachment(MediaAttachment):
+    __slots__ = ()
+
+    @property
+    def filename(self):
+        return self.json.get('filename')
+
+    @property
+    def size(self):
+        return self.json.get('size')
+
+
+class StickerAttachment(MediaAttachment):
+    __slots__ = ()
+
+
+class ShareAttachment(MediaAttachment):
+    __slots__ = ()
+
+
+class ContactAttachment(Attachment):
+    __slots__ = ()
+
+
+class LocationAttachment(Attachment):
+    __slots__ = ()
+
+    @property
+    def latitude(self):
+        return self.json.get('latitude')
+
+    @property
+    def longitude(self):
+        return self.json.get('longitude')
+
+
+class InlineKeyboardAttachment(Attachment):
+    __slots__ = ()
+
+
+Attachment.TYPES.update({
+    'image': ImageAttachment,
+    'video': VideoAttachment,
+    'audio': AudioAttachment,
+    'file': FileAttachment,
+    'sticker': StickerAttachment,
+    'share': ShareAttachment,
+    'contact': ContactAttachment,
+    'location': LocationAttachment,
+    'inline_keyboard': InlineKeyboardAttachment,
+})
+
+
+class MessageBody(JsonObject):
+    __slots__ = ('_attachments',)
+
+    attachments = _Nested('attachments', _list_of(Attachment.de_json), '_attachments')
+
+    @property
+    def mid(self):
+        return self.json.get('mid')
+
+    @property
+    def seq(self):
+        return self.json.get('seq')
+
+    @property
+    def text(self):
+        return self.json.get('text')
+
+
+class LinkedMessage(JsonObject):
+    __slots__ = ('_sender', '_message')
+
+    sender = _Nested('sender', User.de_json, '_sender')
+    message = _Nested('message', MessageBody.de_json, '_message')
+
+    @property
+    def type(self):
+        return self.json.get('type')
+
+    @property
+    def chat_id(self):
+        return self.json.get('chat_id')
+
+
+class Message(JsonObject):
+    __slots__ = ('_sender', '_recipient', '_body', '_link')
+
+    sender = _Nested('sender', User.de_json, '_sender')
+    recipient = _Nested('recipient', Recipient.de_json, '_recipient')
+    body = _Nested('body', MessageBody.de_json, '_body')
+    link = _Nested('link', LinkedMessage.de_json, '_link')
+
+    @property
+    def timestamp(self):
+        return self.json.get('timestamp')
+
+    @property
+    def text(self):
+        return (self.json.get('body') or {}).get('text')
+
+    @property
+    def chat_id(self):
+        return (self.json.get('recipient') or {}).get('chat_id')
+
+
+class Chat(JsonObject):
+    __slots__ = ('_dialog_with_user', '_pinned_message')
+
+    dialog_with_user = _Nested('dialog_with_user', User.de_json, '_dialog_with_user')
+    pinned_message = _Nested('pinned_message', Message.de_json, '_pinned_message')
+
+    @property
+    def chat_id(self):
+        return self.json.get('chat_id')
+
+    @property
+    def type(self):
+        return self.json.get('type')
+
+    @property
+    def status(self):
+        return self.json.get('status')
+
+    @property
+    def title(self):
+        return self.json.get('title')
+
+
+class Callback(JsonObject):
+    __slots__ = ('_user',)
+
+    user = _Nested('user', User.de_json, '_user')
+
+    @property
+    def callback_id(self):
+        return self.json.get('callback_id')
+
+    @property
+    def payload(self):
+        return self.json.get('payload')
+
+
+class Update(JsonObject):
+    __slots__ = ('_message', '_user', '_callback')
+
+    message = _Nested('message', Message.de_json, '_message')
+    user = _Nested('user', User.de_json, '_user')
+    callback = _Nested('callback', Callback.de_json, '_callback')
+
+    @property
+    def update_type(self):
+        return self.json.get('update_type')
+
+    @property
+    def timestamp(self):
+        return self.json.get('timestamp')
+
+    @property
+    def chat_id(self):
+        chat_id = self.json.get('chat_id')
+        if chat_id is None:
+            return ((self.json.get('message') or {}).get('recipient') or {}).get('chat_id')
+        return chat_id
@@ -1,10 +1,17 @@
+import bisect
+import collections
+import heapq
+import itertools
+import json
 import logging
 import random
 import re
 import string
 import sys
 import threading
+import time
 import traceback
+from concurrent import futures
 import six
 from six import string_types
 
@@ -14,6 +21,16 @@ try:
 except ImportError:
     import queue as Queue
 
+# Fast JSON support.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
 logger = logging.getLogger('tambotapi')
 
 thread_local = threading.local()
@@ -69,7 +86,6 @@ class WorkerThread(threading.Thread):
 
                 if self.exception_callback:
                     self.exception_callback(self, self.exc_info)
-                self.continue_event.wait()
 
     def put(self, task, *args, **kwargs):
         self.queue.put((task, args, kwargs))
@@ -88,23 +104,97 @@ class WorkerThread(threading.Thread):
 
 # ThreadPool
 class ThreadPool:
+    """
+    Elastic pool of worker threads.
+    Keeps `num_threads` workers alive and grows up to `max_threads` (default: `num_threads`) while
+    tasks are queued faster than idle workers pick them up; extra workers exit after `idle_timeout`
+    seconds without work. `put` returns a concurrent.futures.Future. A task that raises only fails
+    its own future: the error is logged and kept for raise_exceptions, the worker moves on.
+    """
 
-    def __init__(self, num_threads=2):
+    def __init__(self, num_threads=2, max_threads=None, idle_timeout=5, log_exceptions=True):
         self.tasks = Queue.Queue()
-        self.workers = [WorkerThread(self.on_exception, self.tasks)
-                        for _ in range(num_threads)]
         self.num_threads = num_threads
+        self.max_threads = max(max_threads or num_threads, num_threads)
+        self.idle_timeout = idle_timeout
+        self.log_exceptions = log_exceptions
+        self.lock = threading.Lock()
+        self.workers = []
+        self.idle = 0
+        self.busy_time = 0.0
+        self.idle_time = 0.0
+        self.counter = itertools.count(1)
+        self._running = True
 
         self.exception_event = threading.Event()
         self.exc_info = None
 
+        with self.lock:
+            for _ in range(num_threads):
+                self._spawn()
+
+    def _spawn(self):
+        worker = threading.Thread(target=self._work, name="PoolWorker{0}".format(next(self.counter)))
+        worker.daemon = True
+        self.workers.append(worker)
+        worker.start()
+
     def put(self, func, *args, **kwargs):
-        self.tasks.put((func, args, kwargs))
+        future = futures.Future()
+        self.tasks.put((future, func, args, kwargs))
+        if self.max_threads > self.num_threads:
+            with self.lock:
+                if self._running and self.idle < self.tasks.qsize() and len(self.workers) < self.max_threads:
+                    self._spawn()
+        return future
+
+    def _work(self):
+        current = threading.current_thread()
+        while True:
+            with self.lock:
+                self.idle += 1
+            started = time.monotonic()
+            try:
+                task = self.tasks.get(timeout=self.idle_timeout)
+            except Queue.Empty:
+                task = ()
+            finished = time.monotonic()
+            with self.lock:
+                self.idle -= 1
+                self.idle_time += finished - started
+                if not task and self._running and len(self.workers) > self.num_threads:
+                    # put() may have queued a task after the timeout while still counting this worker
+                    # as idle and so not spawning one; take it rather than leave it stranded.
+                    try:
+                        task = self.tasks.get_nowait()
+                    except Queue.Empty:
+                        pass
+                if task is None or (not task and (not self._running or len(self.workers) > self.num_threads)):
+                    self.workers.remove(current)
+                    return
+            if task:
+                self._run(*task)
+                elapsed = time.monotonic() - finished
+                with self.lock:
+                    self.busy_time += elapsed
+
+    def _run(self, future, func, args, kwargs):
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            if self.log_exceptions:
+                logger.error(type(e).__name__ + " occurred, args=" +
+                             str(e.args) + "\n" + traceback.format_exc())
+            self.on_exception(threading.current_thread(), sys.exc_info())
+            future.set_exception(e)
+        else:
+            future.set_result(result)
 
     def on_exception(self, worker_thread, exc_info):
         self.exc_info = exc_info
         self.exception_event.set()
-        worker_thread.continue_event.set()
 
     def raise_exceptions(self):
         if self.exception_event.is_set():
@@ -113,38 +203,234 @@ class ThreadPool:
     def clear_exceptions(self):
         self.exception_event.clear()
 
+    def stats(self):
+        with self.lock:
+            return {'workers': len(self.workers), 'idle': self.idle, 'active': len(self.workers) - self.idle,
+                    'queued': self.tasks.qsize(), 'busy_seconds': self.busy_time, 'idle_seconds': self.idle_time}
+
     def close(self):
-        for worker in self.workers:
-            worker.stop()
-        for worker in self.workers:
+        with self.lock:
+            self._running = False
+            workers = list(self.workers)
+        for _ in workers:
+            self.tasks.put(None)
+        for worker in workers:
             worker.join()
 
 
+# update_chat_id
+def update_chat_id(update):
+    """
+    Returns the chat an update belongs to, or None when it has none.
+    """
+    chat_id = update.get('chat_id')
+    if chat_id is None:
+        message = update.get('message') or {}
+        chat_id = (message.get('recipient') or {}).get('chat_id')
+    return chat_id
+
+
+# ShardedDispatcher
+class ShardedDispatcher:
+    """
+    Runs tasks in order per key (chat) and in parallel across keys.
+    Keys are hashed onto `num_shards` worker threads. Inside a shard, chats with pending tasks
+    take turns one task at a time, so a hot chat cannot starve the other chats of its shard.
+    `put(func, update)` keys by key_func(update) (default: update_chat_id), which makes it a
+    drop-in for ThreadPool in UpdatePoller.polling and WebhookReceiver.
+    """
+
+    def __init__(self, num_shards=4, key_func=update_chat_id):
+        self.key_func = key_func
+        self.shards = [_Shard("ShardWorker{0}".format(i + 1)) for i in range(num_shards)]
+
+    def put(self, func, update, *args, **kwargs):
+        return self.submit(self.key_func(update), func, update, *args, **kwargs)
+
+    def submit(self, key, func, *args, **kwargs):
+        future = futures.Future()
+        self.shards[hash(key) % len(self.shards)].put(key, (future, func, args, kwargs))
+        return future
+
+    def stats(self):
+        return [shard.stats() for shard in self.shards]
+
+    def close(self):
+        for shard in self.shards:
+            shard.stop()
+        for shard in self.shards:
+            shard.thread.join()
+
+
+class _Shard:
+    def __init__(self, name):
+        self.pending = {}
+        self.ready = collections.deque()
+        self.condition = threading.Condition()
+        self._running = True
+        self.thread = threading.Thread(target=self._work, name=name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, key, task):
+        with self.condition:
+            tasks = self.pending.get(key)
+            if tasks is None:
+                tasks = self.pending[key] = collections.deque()
+                self.ready.append(key)
+            tasks.append(task)
+            self.condition.notify()
+
+    def _work(self):
+        while True:
+            with self.condition:
+                while self._running and not self.ready:
+                    self.condition.wait()
+                if not self.ready:
+                    return
+                key = self.ready.popleft()
+                tasks = self.pending[key]
+                future, func, args, kwargs = tasks.popleft()
+                if tasks:
+                    self.ready.append(key)
+                else:
+                    del self.pending[key]
+            if future.set_running_or_notify_cancel():
+                _run_task(future, func, args, kwargs)
+
+    def stats(self):
+        with self.condition:
+            return {'chats': len(self.pending), 'queued': sum(len(tasks) for tasks in self.pending.values())}
+
+    def stop(self):
+        with self.condition:
+            self._running = False
+            self.condition.notify()
+
+
+def _run_task(future, func, args, kwargs):
+    try:
+        result = func(*args, **kwargs)
+    except Exception as e:
+        logger.error(type(e).__name__ + " occurred, args=" +
+                     str(e.args) + "\n" + traceback.format_exc())
+        future.set_exception(e)
+    else:
+        future.set_result(result)
+
+
+# ProcessDispatcher
+class ProcessDispatcher:
+    """
+    Runs CPU-heavy handlers in a pool of `max_workers` processes (default: one per core).
+    Updates cross the process boundary as JSON bytes encoded with the current JsonCodec, and
+    handlers must be picklable (module-level functions). Whatever a handler returns comes back
+    to this process and, unless None, is passed to `result_handler` (e.g. a function calling
+    apihandler.send_message) on `io_pool` (a ThreadPool) so sending stays on the I/O side; without
+    one, a pool of up to IO_POOL_THREADS threads is created and closed with the dispatcher.
+    put(func, update) returns a Future and matches ThreadPool.put.
+    """
+
+    IO_POOL_THREADS = 16
+
+    def __init__(self, max_workers=None, result_handler=None, io_pool=None):
+        self.executor = futures.ProcessPoolExecutor(max_workers)
+        self.result_handler = result_handler
+        # Handlers must not run on the executor's result thread, which would serialize them
+        # and hold back every later result.
+        self.own_io_pool = result_handler is not None and io_pool is None
+        if self.own_io_pool:
+            io_pool = ThreadPool(2, max_threads=self.IO_POOL_THREADS)
+        self.io_pool = io_pool
+
+    def put(self, func, update, *args, **kwargs):
+        future = self.executor.submit(_process_task, func, json_dumps(update), args, kwargs)
+        if self.result_handler is not None:
+            future.add_done_callback(self._on_done)
+        return future
+
+    def _on_done(self, future):
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is not None:
+            logger.error("Process handler failed: {0!r}".format(error))
+            return
+        result = future.result()
+        if result is None:
+            return
+        self.io_pool.put(self.result_handler, result)
+
+    def close(self, wait=True):
+        self.executor.shutdown(wait=wait)
+        if self.own_io_pool:
+            self.io_pool.close()
+
+
+def _process_task(func, payload, args, kwargs):
+    return func(json_loads(payload), *args, **kwargs)
+
+
 # AsyncTask
 class AsyncTask:
+    """
+    Runs `target` on the shared async pool (see get_async_pool) instead of a thread of its own.
+    """
+
     def __init__(self, target, *args, **kwargs):
         self.target = target
         self.args = args
         self.kwargs = kwargs
+        self.future = get_async_pool().put(target, *args, **kwargs)
 
-        self.done = False
-        self.thread = threading.Thread(target=self._run)
-        self.thread.start()
+    @property
+    def done(self):
+        return self.future.done()
+
+    def wait(self, timeout=None):
+        """
+        Returns the result of `target` or re-raises its exception.
+        :raises concurrent.futures.TimeoutError: if not done within `timeout` seconds.
+        """
+        return self.future.result(timeout)
+
+    def cancel(self):
+        """
+        Cancels the task if it has not started yet, returns True on success.
+        """
+        return self.future.cancel()
+
+
+ASYNC_MAX_WORKERS = 32
+_async_pool = None
+_async_pool_lock = threading.Lock()
 
-    def _run(self):
-        try:
-            self.result = self.target(*self.args, **self.kwargs)
-        except:
-            self.result = sys.exc_info()
-        self.done = True
-
-    def wait(self):
-        if not self.done:
-            self.thread.join()
-        if isinstance(self.result, BaseException):
-            six.reraise(self.result[0], self.result[1], self.result[2])
-        else:
-            return self.result
+
+# get_async_pool
+def get_async_pool():
+    """
+    The bounded ThreadPool behind AsyncTask and async_dec, created on first use with up to
+    ASYNC_MAX_WORKERS threads. Tasks that wait on other async tasks can exhaust it.
+    """
+    global _async_pool
+    if _async_pool is None:
+        with _async_pool_lock:
+            if _async_pool is None:
+                _async_pool = ThreadPool(0, max_threads=ASYNC_MAX_WORKERS, log_exceptions=False)
+    return _async_pool
+
+
+# set_async_pool_size
+def set_async_pool_size(max_workers):
+    get_async_pool().max_threads = max_workers
+
+
+# async_stats
+def async_stats():
+    """
+    :return: counts of active (running) and queued async tasks and of pool threads.
+    """
+    return get_async_pool().stats()
 
 
 # async_dec
@@ -188,7 +474,7 @@ def extract_command(text):
      text: String to extract the command from
     :return: the command if `text` is a command (according to is_command), else None.
     """
-    return text.split()[0].split('@')[0][1:] if is_command(text) else None
+    return text.split(None, 1)[0].partition('@')[0][1:] if is_command(text) else None
 
 
 # split_string
@@ -204,6 +490,52 @@ def split_string(text, chars_per_string):
     return [text[i:i + chars_per_string] for i in range(0, len(text), chars_per_string)]
 
 
+MAX_MESSAGE_LENGTH = 4000
+_astral_regexp = re.compile(u'[\U00010000-\U0010FFFF]')
+
+
+def _utf16_length(text):
+    return len(text.encode('utf-16-le')) // 2
+
+
+# smart_split
+def smart_split(text, chars_per_string=MAX_MESSAGE_LENGTH):
+    """
+    Lazily splits `text` into chunks of at most `chars_per_string` UTF-16 code units (the unit the
+    message length limit is counted in), breaking after the last newline, else the last whitespace,
+    in each window, and never between the halves of a surrogate pair.
+
+     text: The text to split
+     chars_per_string: Maximum chunk length, defaults to the send_message limit. At least 2, the
+        length of a surrogate pair.
+    :return: a generator of strings.
+    :raises ValueError: if chars_per_string is below 2.
+    """
+    if chars_per_string < 2:
+        raise ValueError('chars_per_string must be at least 2, got {0}'.format(chars_per_string))
+    astral = _astral_regexp.search(text) is not None
+    pos = 0
+    length = len(text)
+    while pos < length:
+        end = min(pos + chars_per_string, length)
+        if astral:
+            # Characters outside the BMP count twice, shrink the window until it fits.
+            units = _utf16_length(text[pos:end])
+            while units > chars_per_string:
+                end -= max(1, (units - chars_per_string) // 2)
+                units = _utf16_length(text[pos:end])
+        if end < length:
+            cut = text.rfind('\n', pos, end)
+            if cut <= pos:
+                cut = max(text.rfind(' ', pos, end), text.rfind('\t', pos, end))
+            if cut > pos:
+                end = cut + 1
+            elif u'\ud800' <= text[end - 1] <= u'\udbff' and end - 1 > pos:
+                end -= 1
+        yield text[pos:end]
+        pos = end
+
+
 # or_set
 def or_set(self):
     self._set()
@@ -248,6 +580,10 @@ def OrEvent(*events):
     return or_event
 
 
+# Command, optional @botname suffix and arguments.
+command_regexp = re.compile(r"/([^\s@]*)(?:@(\S*))?\s*([\s\S]*)")
+
+
 # extract_arguments
 def extract_arguments(text):
     """
@@ -261,9 +597,79 @@ def extract_arguments(text):
      text: String to extract the arguments from a command
     :return: the arguments if `text` is a command (according to is_command), else None.
     """
-    regexp = re.compile(r"/\w*(@\w*)*\s*([\s\S]*)", re.IGNORECASE)
-    result = regexp.match(text)
-    return result.group(2) if is_command(text) else None
+    return command_regexp.match(text).group(3) if is_command(text) else None
+
+
+# parse_command
+def parse_command(text):
+    """
+    Splits a command into its parts in a single pass.
+
+    Examples:
+    parse_command('/get@botName name'): ('get', 'botName', 'name')
+    parse_command('/help'): ('help', None, '')
+    parse_command('hello'): None
+
+     text: String to parse
+    :return: (command, bot name or None, arguments) if `text` is a command, else None.
+    """
+    if not is_command(text):
+        return None
+    return command_regexp.match(text).groups()
+
+
+# CommandRouter
+class CommandRouter:
+    """
+    Index of command handlers. Finding the handler of a command is one dict lookup,
+    whatever the number of registered commands. Commands match case-insensitively;
+    commands addressed to another bot (/cmd@OtherBot) are ignored when `bot_name` is set.
+    """
+
+    def __init__(self, bot_name=None):
+        self.bot_name = bot_name.lower() if bot_name else None
+        self.handlers = {}
+
+    def register(self, commands, handler):
+        if is_string(commands):
+            commands = [commands]
+        for command in commands:
+            self.handlers[command.lower()] = handler
+
+    def command_handler(self, *commands):
+        def decorator(handler):
+            self.register(commands, handler)
+            return handler
+
+        return decorator
+
+    def resolve(self, text):
+        """
+        :return: (handler, command, arguments) if `text` is a registered command for this bot, else None.
+        """
+        parsed = parse_command(text)
+        if parsed is None:
+            return None
+        command, bot_name, arguments = parsed
+        if bot_name and self.bot_name and bot_name.lower() != self.bot_name:
+            return None
+        handler = self.handlers.get(command.lower())
+        if handler is None:
+            return None
+        return handler, command, arguments
+
+    def dispatch(self, update):
+        """
+        Calls handler(update, arguments) for a message update carrying a registered command.
+        :return: True if a handler was called.
+        """
+        message = update.get('message') or {}
+        text = (message.get('body') or {}).get('text')
+        route = self.resolve(text) if text else None
+        if route is None:
+            return False
+        route[0](update, route[2])
+        return True
 
 
 # per_thread
@@ -278,3 +684,494 @@ def per_thread(key, construct_value, reset=False):
 # generate_random_token
 def generate_random_token():
     return ''.join(random.sample(string.ascii_letters, 16))
+
+
+# JsonCodec
+class JsonCodec:
+    """
+    A pair of JSON functions: `loads` parses str or bytes, `dumps` returns UTF-8 bytes.
+    """
+
+    def __init__(self, name, loads, dumps):
+        self.name = name
+        self.loads = loads
+        self.dumps = dumps
+
+
+def _stdlib_dumps(obj):
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def _ujson_dumps(obj):
+    return ujson.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+
+JSON_CODECS = {'json': JsonCodec('json', json.loads, _stdlib_dumps)}
+if ujson:
+    JSON_CODECS['ujson'] = JsonCodec('ujson', ujson.loads, _ujson_dumps)
+if orjson:
+    JSON_CODECS['orjson'] = JsonCodec('orjson', orjson.loads, orjson.dumps)
+
+json_codec = JSON_CODECS.get('orjson') or JSON_CODECS.get('ujson') or JSON_CODECS['json']
+
+
+# set_json_codec
+def set_json_codec(codec):
+    """
+    Selects the codec used for request bodies and responses.
+     codec: a name from JSON_CODECS ('orjson', 'ujson', 'json') or a JsonCodec.
+    """
+    global json_codec
+    json_codec = codec if isinstance(codec, JsonCodec) else JSON_CODECS[codec]
+
+
+# json_loads
+def json_loads(data):
+    return json_codec.loads(data)
+
+
+# json_dumps
+def json_dumps(obj):
+    return json_codec.dumps(obj)
+
+
+# TokenBucket
+class TokenBucket:
+    """
+    Token bucket refilled at `rate` tokens per second, holding at most `capacity` tokens.
+    Implemented as GCRA: `tat` is the time at which the bucket is full again,
+    so reservations are O(1) and can be made for a future moment.
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.interval = 1.0 / rate
+        self.tolerance = (capacity - 1) * self.interval
+        self.tat = 0.0
+        self.lock = threading.Lock()
+
+    def reserve(self, at=None):
+        """
+        Takes one token and returns how many seconds after `at` (default: now) it may be used.
+        """
+        now = time.monotonic()
+        at = now if at is None else at
+        with self.lock:
+            tat = max(self.tat, at)
+            self.tat = tat + self.interval
+            return max(0.0, tat - self.tolerance - at)
+
+    def pause(self, seconds):
+        """
+        Holds back every token for `seconds`, e.g. after the server asked to back off.
+        """
+        with self.lock:
+            self.tat = max(self.tat, time.monotonic() + seconds + self.tolerance)
+
+    def is_idle(self, now):
+        return self.tat <= now
+
+
+# RateLimiter
+class RateLimiter:
+    """
+    Outbound rate limiter with a global bucket and one bucket per chat.
+    mode: 'block' makes the caller sleep until its slot, 'queue' schedules the call and
+        returns a concurrent.futures.Future right away (see submit).
+    max_workers: threads running queued calls.
+    """
+
+    def __init__(self, rate=30, burst=30, per_chat_rate=1, per_chat_burst=5, mode='block', max_workers=8,
+                 max_chats=10000):
+        if mode not in ('block', 'queue'):
+            raise ValueError("mode must be 'block' or 'queue'")
+        self.global_bucket = TokenBucket(rate, burst)
+        self.per_chat_rate = per_chat_rate
+        self.per_chat_burst = per_chat_burst
+        self.chat_buckets = {}
+        self.max_chats = max_chats
+        self.mode = mode
+        self.max_workers = max_workers
+        self.lock = threading.Lock()
+
+        self.schedule = []
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        self.executor = None
+        self.scheduler = None
+
+    def _chat_bucket(self, chat_id):
+        with self.lock:
+            bucket = self.chat_buckets.get(chat_id)
+            if bucket is None:
+                if len(self.chat_buckets) >= self.max_chats:
+                    # Idle buckets are full again, so dropping them changes nothing.
+                    now = time.monotonic()
+                    self.chat_buckets = {key: value for key, value in self.chat_buckets.items()
+                                         if not value.is_idle(now)}
+                bucket = self.chat_buckets[chat_id] = TokenBucket(self.per_chat_rate, self.per_chat_burst)
+            return bucket
+
+    def reserve(self, chat_id=None):
+        """
+        Takes a token from the chat bucket and then the global one, returns the delay in seconds.
+        """
+        now = time.monotonic()
+        delay = 0.0
+        if chat_id is not None and self.per_chat_rate:
+            delay = self._chat_bucket(chat_id).reserve(now)
+        return delay + self.global_bucket.reserve(now + delay)
+
+    def acquire(self, chat_id=None):
+        delay = self.reserve(chat_id)
+        if delay > 0:
+            time.sleep(delay)
+
+    def backoff(self, seconds, chat_id=None):
+        """
+        Applies a server backoff signal (HTTP 429 / Retry-After) to the global or a chat bucket.
+        """
+        logger.warning("Rate limited by server, backing off for {0}s".format(seconds))
+        if chat_id is None:
+            self.global_bucket.pause(seconds)
+        else:
+            self._chat_bucket(chat_id).pause(seconds)
+
+    def submit(self, chat_id, func, *args, **kwargs):
+        """
+        Schedules `func` to run on a worker once a token is available, returns a Future.
+        """
+        future = futures.Future()
+        run_at = time.monotonic() + self.reserve(chat_id)
+        with self.condition:
+            self._start()
+            heapq.heappush(self.schedule, (run_at, next(self.counter), future, func, args, kwargs))
+            self.condition.notify()
+        return future
+
+    def _start(self):
+        if self.scheduler is None:
+            self.executor = futures.ThreadPoolExecutor(self.max_workers)
+            self.scheduler = threading.Thread(target=self._run_schedule, name="RateLimiter")
+            self.scheduler.daemon = True
+            self.scheduler.start()
+
+    def _run_schedule(self):
+        while True:
+            with self.condition:
+                while not self.schedule or self.schedule[0][0] > time.monotonic():
+                    timeout = self.schedule[0][0] - time.monotonic() if self.schedule else None
+                    self.condition.wait(timeout)
+                _, _, future, func, args, kwargs = heapq.heappop(self.schedule)
+            if future.set_running_or_notify_cancel():
+                self.executor.submit(_run_future, future, func, args, kwargs)
+
+    def queue_size(self):
+        with self.condition:
+            return len(self.schedule)
+
+
+def _run_future(future, func, args, kwargs):
+    try:
+        future.set_result(func(*args, **kwargs))
+    except BaseException as e:
+        future.set_exception(e)
+
+
+# RetryPolicy
+class RetryPolicy:
+    """
+    Exponential backoff with full jitter: retry `attempt` (0-based) waits a random time
+    between 0 and min(max_backoff, backoff_factor * 2 ** attempt) seconds.
+    """
+
+    def __init__(self, max_retries=3, backoff_factor=0.5, max_backoff=30):
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.max_backoff, self.backoff_factor * (2 ** attempt)))
+
+
+# CircuitBreaker
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failures and rejects calls for `reset_timeout`
+    seconds, then lets a single trial call through (half-open) to decide whether to close again.
+    A trial that neither succeeds nor fails is handed back with release(); one never reported
+    is given up after another `reset_timeout` seconds.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            now = time.monotonic()
+            if self.state != self.CLOSED and now - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self.opened_at = now
+                return True
+            return False
+
+    def release(self):
+        with self.lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+                self.opened_at -= self.reset_timeout
+
+    def record_success(self):
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+
+# prefetch
+def prefetch(iterable, depth=1):
+    """
+    Consumes `iterable` on a background thread, keeping up to `depth` items ready ahead of the caller.
+    Exceptions raised by `iterable` are re-raised in the caller; closing the generator stops the thread.
+
+     iterable: e.g. a generator that fetches pages
+     depth: number of items buffered ahead
+    :return: a generator over the items of `iterable`.
+    """
+    items = Queue.Queue(maxsize=max(1, depth))
+    stop_event = threading.Event()
+
+    def put(item):
+        while not stop_event.is_set():
+            try:
+                items.put(item, timeout=.5)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((True, item)):
+                    return
+        except Exception:
+            put((False, sys.exc_info()))
+        else:
+            put((False, None))
+
+    thread = threading.Thread(target=produce, name="Prefetch")
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            ok, value = items.get()
+            if ok:
+                yield value
+            elif value is None:
+                return
+            else:
+                six.reraise(value[0], value[1], value[2])
+    finally:
+        stop_event.set()
+
+
+# TTLCache
+class TTLCache:
+    """
+    Thread-safe LRU cache whose entries expire `ttl` seconds after being stored.
+    Holds at most `maxsize` entries, evicting the least recently used one first.
+    """
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        :return: (True, value) on a hit, (False, None) on a miss.
+        """
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is not None:
+                if entry[0] > time.monotonic():
+                    self.data.move_to_end(key)
+                    self.hits += 1
+                    return True, entry[1]
+                del self.data[key]
+            self.misses += 1
+            return False, None
+
+    def set(self, key, value):
+        with self.lock:
+            self.data[key] = (time.monotonic() + self.ttl, value)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self.data)}
+
+
+# SingleFlight
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key: while one call for a key is running,
+    others with that key wait for it and share its result or exception instead of calling again.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.executed = 0
+        self.shared = 0
+
+    def do(self, key, func, *args, **kwargs):
+        with self.lock:
+            future = self.calls.get(key)
+            if future is not None:
+                self.shared += 1
+                leader = False
+            else:
+                future = self.calls[key] = futures.Future()
+                self.executed += 1
+                leader = True
+        if leader:
+            try:
+                future.set_result(func(*args, **kwargs))
+            except BaseException as e:
+                # Waiters must be woken even by KeyboardInterrupt or SystemExit, which go on up here.
+                future.set_exception(e)
+                if not isinstance(e, Exception):
+                    raise
+            finally:
+                with self.lock:
+                    del self.calls[key]
+        return future.result()
+
+    def stats(self):
+        with self.lock:
+            return {'executed': self.executed, 'shared': self.shared, 'in_flight': len(self.calls)}
+
+
+# Metrics
+class Metrics:
+    """
+    Thread-safe request metrics in the Prometheus text format, see apihandler.set_metrics.
+    Counts requests and their latency per endpoint and HTTP status (status "" when no response
+    was received) in a histogram with upper bounds `buckets` (seconds), and failed attempts per
+    endpoint and error class. Every observation is also passed to `callback(endpoint, status,
+    seconds, error)` when given, error being the exception class name or None.
+    Stats functions added with register_stats (e.g. ThreadPool.stats, apihandler.get_pool_stats)
+    are exported as gauges when rendering; functions returning a list are labelled by index.
+    """
+
+    DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, callback=None, prefix='tambotapi'):
+        self.buckets = tuple(sorted(buckets))
+        self.callback = callback
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = collections.Counter()
+        self.collectors = {}
+
+    def observe(self, endpoint, status, seconds, error=None):
+        key = (endpoint, '' if status is None else str(status))
+        with self.lock:
+            entry = self.latencies.get(key)
+            if entry is None:
+                entry = self.latencies[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][bisect.bisect_left(self.buckets, seconds)] += 1
+            entry[1] += seconds
+            if error is not None:
+                self.errors[(endpoint, error)] += 1
+        if self.callback is not None:
+            self.callback(endpoint, status, seconds, error)
+
+    def register_stats(self, name, stats_func):
+        self.collectors[name] = stats_func
+
+    def unregister_stats(self, name):
+        self.collectors.pop(name, None)
+
+    def snapshot(self):
+        """
+        :return: {'requests': {(endpoint, status): {'count', 'sum', 'buckets'}},
+                  'errors': {(endpoint, error): count}, 'stats': {name: stats}}
+        """
+        with self.lock:
+            requests = {key: {'count': sum(counts), 'sum': total, 'buckets': list(counts)}
+                        for key, (counts, total) in self.latencies.items()}
+            errors = dict(self.errors)
+        return {'requests': requests, 'errors': errors,
+                'stats': {name: func() for name, func in list(self.collectors.items())}}
+
+    def reset(self):
+        with self.lock:
+            self.latencies.clear()
+            self.errors.clear()
+
+    def render(self):
+        """
+        :return: All metrics in the Prometheus text exposition format (version 0.0.4).
+        """
+        snapshot = self.snapshot()
+        name = self.prefix + '_request_duration_seconds'
+        lines = ['# HELP {0} API request latency by endpoint and HTTP status.'.format(name),
+                 '# TYPE {0} histogram'.format(name)]
+        for (endpoint, status), entry in sorted(snapshot['requests'].items()):
+            labels = 'endpoint="{0}",status="{1}"'.format(endpoint, status)
+            cumulative = 0
+            for bound, count in zip(self.buckets, entry['buckets']):
+                cumulative += count
+                lines.append('{0}_bucket{{{1},le="{2}"}} {3}'.format(name, labels, bound, cumulative))
+            lines.append('{0}_bucket{{{1},le="+Inf"}} {2}'.format(name, labels, entry['count']))
+            lines.append('{0}_sum{{{1}}} {2}'.format(name, labels, entry['sum']))
+            lines.append('{0}_count{{{1}}} {2}'.format(name, labels, entry['count']))
+
+        name = self.prefix + '_request_errors_total'
+        lines += ['# HELP {0} Failed API request attempts by endpoint and error class.'.format(name),
+                  '# TYPE {0} counter'.format(name)]
+        for (endpoint, error), count in sorted(snapshot['errors'].items()):
+            lines.append('{0}{{endpoint="{1}",error="{2}"}} {3}'.format(name, endpoint, error, count))
+
+        for collector, stats in sorted(snapshot['stats'].items()):
+            labelled = [('', stats)] if isinstance(stats, dict) else \
+                [('{{index="{0}"}}'.format(index), item) for index, item in enumerate(stats)]
+            for field in sorted(labelled[0][1]) if labelled else ():
+                name = '{0}_{1}_{2}'.format(self.prefix, collector, field)
+                lines.append('# TYPE {0} gauge'.format(name))
+                for labels, item in labelled:
+                    lines.append('{0}{1} {2}'.format(name, labels, item[field]))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,17 @@
+from tambotapi import apihandler
+
+
+def _message(mid, timestamp):
+    return {'timestamp': timestamp, 'body': {'mid': mid}}
+
+
+def test_iter_messages_keeps_messages_sharing_a_timestamp_across_pages(monkeypatch):
+    history = [_message('m5', 50), _message('m4', 40), _message('m3', 40), _message('m2', 40), _message('m1', 10)]
+
+    def get_messages(token, chat_id=None, message_ids=None, chat_from=None, to=None, count=None):
+        newer_first = [message for message in history if chat_from is None or message['timestamp'] <= chat_from]
+        return {'messages': newer_first[:count]}
+
+    monkeypatch.setattr(apihandler, 'get_messages', get_messages)
+    mids = [message['body']['mid'] for message in apihandler.iter_messages('token', 1, count=2, prefetch=0)]
+    assert mids == ['m5', 'm4', 'm3', 'm2', 'm1']
@@ -0,0 +1,40 @@
+import os
+
+import pytest
+
+import tambotapi
+
+
+def test_recover_skips_journal_older_than_snapshot(tmp_path, monkeypatch):
+    filename = str(tmp_path / 'handlers.save')
+    saver = tambotapi.JournaledSaver({}, filename, 0)
+    saver.set_handler('k', 'v1')
+    assert os.path.isfile(saver.journal_filename)
+
+    # Deleted after the journal flush but before the snapshot copy, then a crash before the journal is removed.
+    saver.handlers.pop('k')
+
+    def crash(path):
+        raise OSError('crash')
+
+    monkeypatch.setattr(os, 'remove', crash)
+    with pytest.raises(OSError):
+        saver.compact()
+    monkeypatch.undo()
+
+    recovered = tambotapi.JournaledSaver({}, filename, 0)
+    recovered.recover()
+    assert recovered.handlers == {}
+
+
+def test_recover_replays_current_journal(tmp_path):
+    filename = str(tmp_path / 'handlers.save')
+    saver = tambotapi.JournaledSaver({}, filename, 0)
+    saver.set_handler('a', 1)
+    saver.compact()
+    saver.set_handler('b', 2)
+    saver.delete_handler('a')
+
+    recovered = tambotapi.JournaledSaver({}, filename, 0)
+    recovered.recover()
+    assert recovered.handlers == {'b': 2}
@@ -0,0 +1,37 @@
+import threading
+
+import tambotapi
+from tambotapi import apihandler
+
+
+def test_update_poller_keeps_batch_arriving_after_stop(monkeypatch):
+    markers = []
+    in_second_poll = threading.Event()
+    release = threading.Event()
+
+    def get_updates(token, limit=None, timeout=None, marker=None, update_types=None):
+        markers.append(marker)
+        if len(markers) == 2:
+            in_second_poll.set()
+            release.wait(5)
+        position = marker or 0
+        return {'updates': [position + 1], 'marker': position + 1}
+
+    monkeypatch.setattr(apihandler, 'get_updates', get_updates)
+    poller = tambotapi.UpdatePoller('token', max_pending=1)
+
+    batches = poller.iter_batches()
+    assert next(batches) == [1]
+    assert in_second_poll.wait(5)
+    # Stopped while the second poll is in flight: its batch must survive and the marker stay put.
+    poller.stop()
+    release.set()
+    assert list(batches) == []
+    poller.thread.join(5)
+    assert poller.marker == 1
+
+    batches = poller.iter_batches()
+    assert next(batches) == [2]
+    assert next(batches) == [3]
+    poller.stop()
+    assert markers[:3] == [None, 1, 2]
@@ -0,0 +1,67 @@
+import threading
+
+import pytest
+
+from tambotapi import util
+
+
+class _DelayedEmptyQueue(util.Queue.Queue):
+    """
+    Queue whose timed-out get() pauses before raising Empty, until `release` is set.
+    """
+
+    def __init__(self):
+        util.Queue.Queue.__init__(self)
+        self.timed_out = threading.Event()
+        self.release = threading.Event()
+
+    def get(self, block=True, timeout=None):
+        try:
+            return util.Queue.Queue.get(self, block, timeout)
+        except util.Queue.Empty:
+            self.timed_out.set()
+            self.release.wait(5)
+            raise
+
+
+def test_thread_pool_idle_worker_does_not_strand_task():
+    pool = util.ThreadPool(0, max_threads=1, idle_timeout=.05)
+    pool.tasks = _DelayedEmptyQueue()
+    assert pool.put(lambda: 1).result(timeout=5) == 1
+
+    # The only worker timed out waiting; queue a task before it decides to exit.
+    assert pool.tasks.timed_out.wait(5)
+    future = pool.put(lambda: 2)
+    pool.tasks.release.set()
+    assert future.result(timeout=5) == 2
+    pool.close()
+
+
+
+def test_async_task_not_stranded_by_idle_worker(monkeypatch):
+    # The shared async pool keeps no resident workers, so it relies on ThreadPool never stranding a task.
+    pool = util.ThreadPool(0, max_threads=1, idle_timeout=.05, log_exceptions=False)
+    pool.tasks = _DelayedEmptyQueue()
+    monkeypatch.setattr(util, '_async_pool', pool)
+
+    @util.async_dec()
+    def add(a, b):
+        return a + b
+
+    assert add(1, 2).wait(5) == 3
+    assert pool.tasks.timed_out.wait(5)
+    task = add(2, 3)
+    pool.tasks.release.set()
+    assert task.wait(5) == 5
+    pool.close()
+
+
+def test_smart_split_keeps_surrogate_pairs_whole():
+    text = u'\U0001F600' * 5
+    assert list(util.smart_split(text, 3)) == [u'\U0001F600'] * 5
+    assert list(util.smart_split(text, 2)) == [u'\U0001F600'] * 5
+
+
+def test_smart_split_rejects_window_below_surrogate_pair():
+    with pytest.raises(ValueError):
+        list(util.smart_split(u'\U0001F600', 1))
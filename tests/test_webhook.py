@@ -0,0 +1,46 @@
+import json
+import socket
+
+import tambotapi
+
+
+def _post(address, body, headers=None):
+    connection = socket.create_connection(address, timeout=5)
+    try:
+        head = 'POST /hook HTTP/1.1\r\nHost: localhost\r\n'
+        for name, value in (headers or {'Content-Length': str(len(body))}).items():
+            head += '{0}: {1}\r\n'.format(name, value)
+        connection.sendall(head.encode('ascii') + b'\r\n' + body)
+        return int(connection.recv(1024).split(b' ', 2)[1])
+    finally:
+        connection.close()
+
+
+def _receiver(**kwargs):
+    receiver = tambotapi.WebhookReceiver('token', 'https://example.com/hook', host='127.0.0.1', port=0,
+                                         path='/hook', **kwargs)
+    receiver.start(subscribe=False)
+    return receiver
+
+
+def test_webhook_receiver_queues_posted_updates():
+    receiver = _receiver()
+    try:
+        update = {'update_type': 'message_created', 'timestamp': 1}
+        assert _post(receiver.server_address, json.dumps(update).encode('utf-8')) == 200
+        assert next(receiver.iter_updates()) == update
+    finally:
+        receiver.stop(unsubscribe=False)
+
+
+def test_webhook_receiver_rejects_bad_lengths():
+    receiver = _receiver(max_body_size=16)
+    try:
+        assert _post(receiver.server_address, b'{}', {'Content-Length': '-1'}) == 400
+        assert _post(receiver.server_address, b'{}', {'Content-Length': 'abc'}) == 400
+        assert _post(receiver.server_address, b'', {}) == 400
+        assert _post(receiver.server_address, b'{"x": "' + b'y' * 32 + b'"}') == 413
+        assert _post(receiver.server_address, b'not json') == 400
+        assert receiver.updates.empty()
+    finally:
+        receiver.stop(unsubscribe=False)